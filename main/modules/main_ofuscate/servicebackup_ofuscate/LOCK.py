@@ -6,13 +6,35 @@ It monitors for any changes and restores files from backup if changes are detect
 Author: Development Team COCIBER PT
 """
 
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import gzip
 import hashlib
+import heapq
+import io
+import json
+import mmap
 import os
+import queue
+import random
+import re
+import select
+import shlex
+import sqlite3
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 import logging
 import time
 import paramiko
-from scp import SCPClient
 import signal
 from logging.handlers import RotatingFileHandler
 import socket
@@ -53,28 +75,77 @@ SCP_SERVER = '172.20.10.4'
 SCP_USER = 'joaog'
 SCP_PASSWORD = 'joaog'  # It's recommended to use SSH key authentication instead
 SCP_REMOTE_PATH = '/tmp/backups'
+REMOTE_BACKUP_DIR = os.path.join(SCP_REMOTE_PATH, local_ip, 'backup')
+SSH_KEEPALIVE = 15  # Seconds between keepalive packets on the pooled SSH connection
+SSH_RECONNECT_MIN_DELAY = 1  # Seconds to wait before the first reconnect attempt
+SSH_RECONNECT_MAX_DELAY = 60  # Upper bound for the exponential reconnect backoff
+SSH_TIMEOUT = 30  # Seconds a connect or remote transfer may stall before it is abandoned
+SHIP_INTERVAL = 10  # Seconds between shipments of the log and journal to the SCP server
+SHIP_BATCH = 1024 * 1024  # Bytes compressed into each gzip member sent to the server
+JOURNAL_FILE = f"{local_ip}_journal.jsonl"  # Append-only record of tamper events, restores and baselines
+JOURNAL_COMPACT_BYTES = 1024 * 1024  # The journal is emptied once this much of it was shipped
+BULK_TRANSFER_MIN_FILES = 32  # Transfers of at least this many blobs are streamed as one tar archive, 0 disables
+BULK_TRANSFER_COMPRESSION = 'gz'  # Compression of bulk tar streams: '' (none), 'gz' (zlib) or 'xz' (lzma)
+BULK_SUMS_FILE = '.bulk.sha256'  # Checksum list appended to bulk uploads and verified on the server
+TAR_COMPRESSION_FLAGS = {'': '', 'gz': 'z', 'xz': 'J'}
 
 # Relative Path
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
 # Directories and file paths
-MONITOR_CFG = f'{dir_path}/services.cfg' # Config file listing files to monitor
+MONITOR_CFG = f'{dir_path}/services.cfg' # Config file listing files to monitor, and !glob lines excluded from its directories
+CFG_ATTRIBUTE = re.compile(r'\s+(\w+)=(\S*)$')  # Trailing key=value attribute of a services.cfg line
 BACKUP_DIR = f'{dir_path}/backup'
 QUARANTINE_DIR = f'{dir_path}/quarantine'
-MANIFEST_FILE = 'backup_manifest.csv'  # Manifest file listing file hashes
+RESTORE_TEMP_NAME = re.compile(r'^\..+\.lock-\w+$')  # Temporary file names used by replace_file_atomically()
+MANIFEST_FILE = 'backup_manifest.db'  # SQLite manifest listing file hashes, permissions and fingerprints
+LEGACY_MANIFEST_FILE = 'backup_manifest.csv'  # Comma-separated manifest written by older versions
+MANIFEST_SCHEMA_VERSION = 2  # Stored in PRAGMA user_version
+MONITOR_INTERVAL = 10  # Seconds between checks of files in the 'normal' tier, and between scheduler reports
+SCAN_TIERS = {'critical': 1, 'normal': MONITOR_INTERVAL, 'bulk': 60}  # Seconds between checks of the files in each tier, set with tier=<name> in services.cfg
+DEFAULT_SCAN_TIER = 'normal'  # Tier of the files services.cfg assigns none
+PARANOID_REHASH_CYCLES = 60  # Every file is fully rehashed at least once every N checks (0 disables)
+HASH_CHUNK_SIZE = 1024 * 1024  # Bytes read per hashing step, bounds memory used per hash
+HASH_MMAP_THRESHOLD = 0  # Hash files of at least this many bytes through mmap (0 disables)
+HASH_WORKERS = os.cpu_count() or 1  # Threads hashing files during the baseline and on-demand checks
+SWEEP_BYTES_PER_SECOND = 32 * 1024 * 1024  # Bytes scheduled full rehashes of unchanged files may read per second (0 = unlimited)
+SWEEP_HASHES_PER_SECOND = 0  # Scheduled full rehashes of unchanged files per second (0 = unlimited)
+SWEEP_EXEMPT_TIERS = ('critical',)  # Scan tiers checked at full speed, like inotify events and the startup check
+QUARANTINE_NEW_FILES = False  # Move files that appear in monitored directories into QUARANTINE_DIR instead of only reporting them
+PIPELINE_HASH_DEPTH = 256  # Files being hashed or waiting for the comparator at a time, before the stat stage waits
+PIPELINE_RESTORE_DEPTH = 64  # Restores queued or running at a time, before the comparator waits
+PIPELINE_POLL = 0.01  # Seconds between looks for finished hashes and restores while any are in flight
+SWEEP_NICE = 10  # Niceness of the thread rehashing for scheduled checks (0 keeps the monitor's)
+SWEEP_IONICE = '-c 2 -n 7'  # ionice arguments for that thread, lowest best-effort I/O priority by default (empty disables)
+USE_INOTIFY = True  # Verify files as soon as inotify reports a change; unwatched files are still polled
+INOTIFY_SETTLE = 0.05  # Seconds to let a burst of events settle before verifying the affected files
+FOLLOW_SYMLINKS = False  # Descend into symlinked directories when walking the configured directories
+BASELINE_BATCH = 4096  # Files handed to the hashing pool at a time while the baseline streams from the directory walk
+WARM_START = True  # Keep the backup store and manifest across restarts instead of taking a new baseline
+WARM_START_SAMPLE = 64  # Backup copies re-hashed at a warm start to spot-check the store
+PINNED_PATHS = []  # fnmatch patterns of small critical files kept verified in memory for instant restore, e.g. ['/etc/passwd', '/etc/sudoers', '/root/.ssh/authorized_keys']
+PINNED_MAX_BYTES = 1024 * 1024  # Memory budget for the pinned copies of PINNED_PATHS
+RESTORE_CACHE_MAX_BYTES = 16 * 1024 * 1024  # Memory kept for recently restored backup copies
+RESTORE_CACHE_MAX_FILE = 64 * 1024  # Only backup copies up to this size are cached in memory
+LOCAL_STORE_MAX_BYTES = 0  # Evict least recently used copies from the local store above this size, the server keeps them (0 disables)
 
 # Create necessary directories if they don't exist
 os.makedirs(BACKUP_DIR, exist_ok=True)
 os.makedirs(QUARANTINE_DIR, exist_ok=True)
 
 running = True
+hash_buffers = threading.local()  # Reusable read buffer for hash_file(), one per hashing thread
+hash_pool = None  # Thread pool shared by every hash_files() call
+sweep_pool = None  # Single demoted thread rehashing for scheduled checks
+store_synced = False  # Whether the server holds the current baseline, set by sync_backup_store()
+restore_stats = {tier: {'hits': 0, 'misses': 0} for tier in ('pinned', 'memory', 'local', 'remote')}  # Restores served per tier
 
 def handle_stop_signals(signum, frame):
     global running
     running = False
     logging.info("Received stop signal, shutting down...")
 
-    if os.path.exists(BACKUP_DIR):
+    if not WARM_START and os.path.exists(BACKUP_DIR):
         shutil.rmtree(BACKUP_DIR)
         logging.info("Local backup directory deleted.")
 
@@ -82,183 +153,2174 @@ def create_scp_session():
     """ Create an SCP session for file transfers """
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(SCP_SERVER, username=SCP_USER, password=SCP_PASSWORD)
+    ssh.connect(SCP_SERVER, username=SCP_USER, password=SCP_PASSWORD, timeout=SSH_TIMEOUT, banner_timeout=SSH_TIMEOUT, auth_timeout=SSH_TIMEOUT)
     return ssh
 
-def hash_file(filepath):
-    """ Generate SHA-256 hash for the specified file """
+class SSHConnectionPool:
+    """
+    Keeps one warm SSH connection to the SCP server and a single SFTP channel on it.
+
+    The connection is opened lazily, kept alive with SSH keepalives and re-established when it
+    drops; failed attempts back off exponentially between SSH_RECONNECT_MIN_DELAY and
+    SSH_RECONNECT_MAX_DELAY instead of blocking the caller. connect is any callable returning a
+    connected paramiko.SSHClient-like object, so a local stand-in can replace the real server.
+    """
+
+    def __init__(self, connect=create_scp_session):
+        self.connect = connect
+        self.client = None
+        self.sftp_client = None
+        self.lock = threading.RLock()
+        self.delay = SSH_RECONNECT_MIN_DELAY
+        self.next_attempt = 0
+        self.stats = {'connects': 0, 'reconnects': 0, 'failed_connects': 0, 'session_reuses': 0, 'sftp_opens': 0, 'sftp_reuses': 0}
+
+    def is_alive(self):
+        transport = self.client.get_transport() if self.client is not None else None
+        return transport is not None and transport.is_active()
+
+    def session(self):
+        """ Return the live SSH client, reconnecting if needed; raises ConnectionError while backing off """
+        with self.lock:
+            if self.is_alive():
+                self.stats['session_reuses'] += 1
+                return self.client
+            self.reset()
+            now = time.monotonic()
+            if now < self.next_attempt:
+                raise ConnectionError(f"SCP server unreachable, next reconnect attempt in {self.next_attempt - now:.0f}s")
+            try:
+                client = self.connect()
+                client.get_transport().set_keepalive(SSH_KEEPALIVE)
+            except Exception as e:
+                self.stats['failed_connects'] += 1
+                self.next_attempt = now + self.delay
+                self.delay = min(self.delay * 2, SSH_RECONNECT_MAX_DELAY)
+                raise ConnectionError(f"Failed to connect to SCP server {SCP_SERVER}: {e}") from e
+            if self.stats['connects']:
+                self.stats['reconnects'] += 1
+                logging.info(f"Reconnected to SCP server {SCP_SERVER}.")
+            self.stats['connects'] += 1
+            self.client = client
+            self.delay = SSH_RECONNECT_MIN_DELAY
+            return client
+
+    def sftp(self):
+        """ Return the pooled SFTP channel, opening it on the current connection if needed """
+        with self.lock:
+            client = self.session()
+            if self.sftp_client is not None and not self.sftp_client.get_channel().closed:
+                self.stats['sftp_reuses'] += 1
+                return self.sftp_client
+            self.sftp_client = client.open_sftp()
+            self.sftp_client.get_channel().settimeout(SSH_TIMEOUT)
+            self.stats['sftp_opens'] += 1
+            return self.sftp_client
+
+    def run(self, operation):
+        """
+        Run operation(sftp) on the pooled SFTP channel.
+
+        If it fails because the connection died, the connection is re-established and the
+        operation retried once; errors on a healthy connection (e.g. a missing remote file) are raised.
+        """
+        for attempt in range(2):
+            sftp = self.sftp()
+            try:
+                return operation(sftp)
+            except (OSError, EOFError, paramiko.SSHException):
+                if attempt or self.is_alive():
+                    raise
+                logging.warning("SCP connection lost, reconnecting.")
+
+    def reset(self):
+        """ Drop the current connection and its SFTP channel """
+        with self.lock:
+            for resource in (self.sftp_client, self.client):
+                if resource is not None:
+                    try:
+                        resource.close()
+                    except Exception:
+                        pass
+            self.sftp_client = None
+            self.client = None
+
+    def describe(self):
+        return ', '.join(f"{name}: {count}" for name, count in self.stats.items())
+
+    def close(self):
+        self.reset()
+        logging.info(f"SCP connection pool closed ({self.describe()}).")
+
+def get_hash_buffer(chunk_size):
+    """ Return this thread's hashing buffer, reallocating it only when the chunk size changes """
+    buffer = getattr(hash_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != chunk_size:
+        buffer = hash_buffers.buffer = bytearray(chunk_size)
+    return buffer
+
+def hash_stream(f, hasher, chunk_size):
+    """ Feed an unbuffered binary file into hasher one chunk at a time """
+    buffer = get_hash_buffer(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        count = f.readinto(buffer)
+        if not count:
+            break
+        hasher.update(view[:count])
+
+def hash_mmap(f, hasher, chunk_size):
+    """
+    Feed a file into hasher through a read-only memory map.
+
+    Pages are faulted in on demand and can be dropped by the kernel at any time, so resident
+    memory stays bounded. The file must not be truncated while it is mapped (SIGBUS), which is
+    why this path is opt-in through HASH_MMAP_THRESHOLD.
+    """
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mm) as view:
+            for offset in range(0, len(view), chunk_size):
+                hasher.update(view[offset:offset + chunk_size])
+
+def hash_file(filepath, chunk_size=HASH_CHUNK_SIZE):
+    """ Generate SHA-256 hash for the specified file using constant memory """
     hasher = hashlib.sha256()
     try:
-        with open(filepath, 'rb') as f:
-            hasher.update(f.read())
+        with open(filepath, 'rb', buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            if HASH_MMAP_THRESHOLD and size >= HASH_MMAP_THRESHOLD:
+                hash_mmap(f, hasher, chunk_size)
+            else:
+                hash_stream(f, hasher, chunk_size)
         return hasher.hexdigest()
     except Exception as e:
         logging.error(f"Failed to hash file {filepath}: {e}")
         return None
-    
-def scp_transfer(ssh_session, local_path, remote_path):
+
+def demote_sweep_thread():
+    """ Lower the CPU and I/O priority of the calling thread to SWEEP_NICE and SWEEP_IONICE """
+    tid = threading.get_native_id()  # Linux applies both priorities per thread, so the monitor keeps its own
+    try:
+        if SWEEP_NICE:
+            os.setpriority(os.PRIO_PROCESS, tid, max(os.getpriority(os.PRIO_PROCESS, tid), SWEEP_NICE))
+        if SWEEP_IONICE:
+            subprocess.run(['ionice', *SWEEP_IONICE.split(), '-p', str(tid)], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning(f"Could not lower the priority of the background hashing thread: {e}")
+
+def get_hash_executor(background=False):
+    """ The shared pool of HASH_WORKERS hashing threads, or the demoted sweep thread if background, created on first use """
+    global hash_pool, sweep_pool
+    if background:
+        if sweep_pool is None:
+            sweep_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sweep', initializer=demote_sweep_thread)
+        return sweep_pool
+    if hash_pool is None:
+        hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='hash')
+    return hash_pool
+
+def map_on_hash_pool(func, items):
+    """ Apply func to every item on HASH_WORKERS threads, returning the results in the order of items """
+    if HASH_WORKERS <= 1 or len(items) < 2:
+        return [func(item) for item in items]
+    return list(get_hash_executor().map(func, items))
+
+def hash_files(filepaths):
     """
-    Transfer a file or directory to the SCP server, ensuring the remote path exists.
-    
-    :param ssh_session: An active SSH session.
-    :param local_path: The local path of the file or directory to transfer.
-    :param remote_path: The remote destination path on the SCP server.
+    Hash many files on HASH_WORKERS threads.
+
+    hashlib releases the GIL while digesting large chunks, so hashing scales with cores.
+
+    :return: The hashes (or None for unreadable files) in the same order as filepaths.
     """
-    # Command to create the remote directory structure if it doesn't exist
-    mkdir_command = f'mkdir -p {remote_path}'
-    
-    # Execute the mkdir command on the remote server
-    stdin, stdout, stderr = ssh_session.exec_command(mkdir_command)
-    exit_status = stdout.channel.recv_exit_status()  # Wait for the command to complete
-    
-    if exit_status == 0:
-        logging.info(f"Ensured remote directory exists: {remote_path}.")
-    else:
-        logging.error(f"Failed to ensure remote directory exists: {remote_path}. stderr: {stderr.read().decode()}")
-        return  # Exit if the directory could not be created
-
-    # Proceed to transfer the file or directory
-    with SCPClient(ssh_session.get_transport()) as scp:
-        scp.put(local_path, remote_path=remote_path, recursive=True)
-        logging.info(f"Successfully transferred {local_path} to {remote_path}.")
-
-def backup_and_hash_files():
-    files_to_monitor = read_cfg_file(MONITOR_CFG)
-    manifest = {}
-    for filepath in files_to_monitor:
-        file_hash = hash_file(filepath)
-        stat_info = os.stat(filepath)
-        file_permissions = stat_info.st_mode & 0o777
-        uid = stat_info.st_uid
-        gid = stat_info.st_gid
-        if file_hash:
-            manifest[filepath] = (file_hash, file_permissions, uid, gid)
-            backup_path = shutil.copy2(filepath, BACKUP_DIR)
-            logging.info(f"Backed up and hashed file: {filepath}, with permissions {oct(file_permissions)}, UID: {uid}, GID: {gid}. Backup path: {backup_path}")
+    return map_on_hash_pool(hash_file, filepaths)
+
+def copy_and_hash(src, dst, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Copy the unbuffered binary file src into dst in a single pass, hashing the bytes on the way.
+
+    :return: The SHA-256 hex digest of the copied content.
+    """
+    hasher = hashlib.sha256()
+    buffer = get_hash_buffer(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        count = src.readinto(buffer)
+        if not count:
+            break
+        hasher.update(view[:count])
+        dst.write(view[:count])
+    return hasher.hexdigest()
+
+def blob_path(file_hash, root=BACKUP_DIR):
+    """ Location of the backup copy of content with the given hash, sharded by its first two hex digits """
+    return os.path.join(root, file_hash[:2], file_hash)
 
-    with open(os.path.join(BACKUP_DIR, MANIFEST_FILE), 'w') as f:
-        for path, (file_hash, permissions, uid, gid) in manifest.items():
-            f.write(f"{path},{file_hash},{permissions},{uid},{gid}\n")
+def backup_file(filepath):
+    """
+    Copy a file into the content-addressed backup store, hashing it in the same pass.
+
+    The copy is staged in BACKUP_DIR and renamed to its hash once known; content that is
+    already stored is discarded, so identical files share one backup copy.
 
-    ssh_session = create_scp_session()
-    scp_transfer(ssh_session, BACKUP_DIR, os.path.join(SCP_REMOTE_PATH, local_ip))
-    ssh_session.close()
-    logging.info("Backup files and manifest transferred to SCP server.")
+    :return: A (file_hash, stat_info, backup_path, newly_stored) tuple, or None if the file could not be backed up.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=BACKUP_DIR, prefix='.tmp-')
+    try:
+        with open(filepath, 'rb', buffering=0) as src, os.fdopen(fd, 'wb') as dst:
+            stat_info = os.fstat(src.fileno())
+            file_hash = copy_and_hash(src, dst)
+        backup_path = blob_path(file_hash)
+        if os.path.exists(backup_path):
+            os.unlink(temp_path)
+            return file_hash, stat_info, backup_path, False
+        os.utime(temp_path, ns=(stat_info.st_atime_ns, stat_info.st_mtime_ns))
+        os.makedirs(os.path.dirname(backup_path), exist_ok=True)
+        os.replace(temp_path, backup_path)
+        return file_hash, stat_info, backup_path, True
+    except Exception as e:
+        logging.error(f"Failed to back up file {filepath}: {e}")
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        return None
 
+FINGERPRINT_STRUCT = struct.Struct('<qqqQQ')  # Packed stat fingerprint, as kept in memory and in the manifest
 
-def send_logs_to_scp(ssh_session):
-    """ Send the logs to SCP server """
-    remote_log_file = os.path.join(SCP_REMOTE_PATH, local_ip, log_file)
-    with SCPClient(ssh_session.get_transport()) as scp:
-        scp.put(log_file, remote_path=remote_log_file)
+def stat_fingerprint(stat_info):
+    """ Cheap change detector for a file: packed (size, mtime_ns, ctime_ns, inode, device) """
+    return FINGERPRINT_STRUCT.pack(stat_info.st_size, stat_info.st_mtime_ns, stat_info.st_ctime_ns, stat_info.st_ino, stat_info.st_dev)
 
-def fetch_backup_manifest(ssh_session, local_manifest_path):
-    """Download the backup manifest file from the SCP server."""
-    remote_manifest_path = os.path.join(SCP_REMOTE_PATH, local_ip, MANIFEST_FILE)
-    
-    # Attempt to check if the remote manifest exists before fetching
-    stdin, stdout, stderr = ssh_session.exec_command(f"test -f {remote_manifest_path} && echo 'exists' || echo 'not exists'")
-    if stdout.read().decode().strip() != "exists":
-        logging.error(f"Remote manifest file does not exist: {remote_manifest_path}")
-        # Handle the error (e.g., retry, create a new file, or abort)
+def file_fingerprint(filepath):
+    """ Stat fingerprint of the specified file, or None if it cannot be stat'ed """
+    try:
+        return stat_fingerprint(os.stat(filepath))
+    except OSError:
+        return None
+
+def manifest_digests(conn):
+    """ Return the set of binary digests referenced by the manifest database open on conn """
+    return {row[0] for row in conn.execute('SELECT DISTINCT hash FROM files')}
+
+def open_manifest_image(data):
+    """
+    Open the bytes of a manifest database as an in-memory SQLite database.
+
+    Python before 3.11 has no Connection.deserialize(), so there the bytes are written to a
+    temporary file and copied into memory with the backup API.
+    """
+    image = bytearray(data)
+    if len(image) >= 20 and image[18:20] == b'\x02\x02':
+        image[18:20] = b'\x01\x01'  # An in-memory image cannot be opened in WAL mode
+    conn = sqlite3.connect(':memory:')
+    try:
+        if hasattr(conn, 'deserialize'):
+            conn.deserialize(bytes(image))
+        else:
+            load_manifest_image(conn, image)
+        conn.execute('SELECT count(*) FROM files').fetchone()
+    except sqlite3.Error:
+        conn.close()
+        raise
+    return conn
+
+def load_manifest_image(conn, image):
+    """ Copy a manifest image into the database of conn through a temporary file """
+    with tempfile.NamedTemporaryFile(dir=BACKUP_DIR, prefix='.tmp-') as f:
+        f.write(image)
+        f.flush()
+        source = sqlite3.connect(f.name)
+        try:
+            source.backup(conn)
+        finally:
+            source.close()
+
+def fetch_remote_manifest(ssh_pool, local_hash=None):
+    """
+    Fetch the server's copy of the manifest in a single request, unless it matches the local copy.
+
+    The server replies with a "<sha256> <size>" line for its copy and streams the content only if
+    that digest differs from local_hash; the content is checked against the header before it is used.
+
+    :return: None if the server's copy has local_hash, b'' if the server has no manifest, otherwise its content.
+    """
+    remote_manifest_path = shlex.quote(os.path.join(REMOTE_BACKUP_DIR, MANIFEST_FILE))
+    command = (f'f={remote_manifest_path}; [ -f "$f" ] || {{ echo missing; exit 0; }}; '
+               f'set -- $(sha256sum < "$f") $(wc -c < "$f"); echo "$1 $3"; [ "$1" = {local_hash or "none"} ] || cat "$f"')
+    stdin, stdout, stderr = ssh_pool.session().exec_command(command, timeout=SSH_TIMEOUT)
+    header = stdout.readline()
+    header = (header.decode() if isinstance(header, bytes) else header).split()
+    if header == ['missing']:
+        return b''
+    if len(header) != 2:
+        raise OSError(f"Unexpected reply to the manifest request: {' '.join(header) or stderr.read().decode(errors='replace').strip()}")
+    remote_hash, size = header[0], int(header[1])
+    if remote_hash == local_hash:
+        return None
+    data = stdout.read(size)
+    if len(data) != size or hashlib.sha256(data).hexdigest() != remote_hash:
+        raise OSError("The manifest downloaded from the server is truncated or corrupted.")
+    return data
+
+def sftp_makedirs(sftp, path, known):
+    """ mkdir -p over SFTP; known is a set of directories already checked, shared between calls """
+    if path in known or path in ('', '/'):
         return
-    
-    with SCPClient(ssh_session.get_transport()) as scp:
+    try:
+        sftp.stat(path)
+    except FileNotFoundError:
+        sftp_makedirs(sftp, os.path.dirname(path), known)
+        sftp.mkdir(path)
+    known.add(path)
+
+def upload_blobs(sftp, hashes):
+    """
+    Upload blobs from the local store to the server one file at a time.
+
+    :return: Number of bytes uploaded.
+    """
+    known = set()
+    uploaded = 0
+    for file_hash in hashes:
+        remote_path = blob_path(file_hash, REMOTE_BACKUP_DIR)
+        sftp_makedirs(sftp, os.path.dirname(remote_path), known)
+        uploaded += sftp.put(blob_path(file_hash), remote_path).st_size
+    return uploaded
+
+def upload_blobs_bulk(ssh_pool, hashes):
+    """
+    Stream blobs from the local store to the server as a single tar archive over one exec channel.
+
+    The archive ends with a sha256sum list of its members, checked on the server with
+    `sha256sum -c` before the command exits, so every member is verified where it landed.
+
+    :return: Number of blob bytes uploaded.
+    :raises OSError: If the server could not unpack or verify the archive.
+    """
+    remote_dir = shlex.quote(REMOTE_BACKUP_DIR)
+    flag = TAR_COMPRESSION_FLAGS[BULK_TRANSFER_COMPRESSION]
+    command = (f"mkdir -p {remote_dir} && cd {remote_dir} && tar -x{flag}f - && sha256sum --quiet -c {BULK_SUMS_FILE}; "
+               f"status=$?; rm -f {BULK_SUMS_FILE}; exit $status")
+    stdin, stdout, stderr = ssh_pool.session().exec_command(command, timeout=SSH_TIMEOUT)
+    uploaded = 0
+    sums = []
+    with tarfile.open(fileobj=stdin, mode=f'w|{BULK_TRANSFER_COMPRESSION}') as tar:
+        for file_hash in hashes:
+            name = os.path.relpath(blob_path(file_hash), BACKUP_DIR)
+            info = tar.gettarinfo(blob_path(file_hash), arcname=name)
+            with open(blob_path(file_hash), 'rb') as f:
+                tar.addfile(info, f)
+            uploaded += info.size
+            sums.append(f"{file_hash}  {name}\n")
+        data = ''.join(sums).encode()
+        info = tarfile.TarInfo(BULK_SUMS_FILE)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    stdin.channel.shutdown_write()
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        output = (stdout.read() + stderr.read()).decode(errors='replace').strip()
+        raise OSError(f"Bulk upload was rejected by the server (exit status {status}): {output}")
+    return uploaded
+
+def store_blob(src, file_hash):
+    """ Write the content read from src into the local store as file_hash, keeping it only if its digest matches """
+    fd, temp_path = tempfile.mkstemp(dir=BACKUP_DIR, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            actual_hash = copy_and_hash(src, dst)
+        if actual_hash != file_hash:
+            logging.error(f"Downloaded backup copy of {file_hash} has hash {actual_hash}, discarding it.")
+            os.unlink(temp_path)
+            return False
+        os.makedirs(os.path.dirname(blob_path(file_hash)), exist_ok=True)
+        os.replace(temp_path, blob_path(file_hash))
+        return True
+    except Exception:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+def download_blobs_bulk(ssh_pool, hashes):
+    """
+    Fetch blobs from the server into the local store as a single tar archive over one exec channel.
+
+    Each member is hashed while it is unpacked and kept only if the digest matches its name.
+    Blobs the server does not have are left out of the archive.
+
+    :return: The set of hashes that were fetched and verified.
+    """
+    wanted = {os.path.relpath(blob_path(file_hash), BACKUP_DIR): file_hash for file_hash in hashes}
+    if not wanted:
+        return set()
+    flag = TAR_COMPRESSION_FLAGS[BULK_TRANSFER_COMPRESSION]
+    stdin, stdout, stderr = ssh_pool.session().exec_command(f"cd {shlex.quote(REMOTE_BACKUP_DIR)} && tar -c{flag}f - -T -", timeout=SSH_TIMEOUT)
+
+    def send_names():
+        # Fed from a thread: the server starts streaming before it has read the whole list
+        stdin.write(''.join(f"{name}\n" for name in wanted))
+        stdin.channel.shutdown_write()
+
+    feeder = threading.Thread(target=send_names, daemon=True)
+    feeder.start()
+    fetched = set()
+    with tarfile.open(fileobj=stdout, mode=f'r|{BULK_TRANSFER_COMPRESSION}') as tar:
+        for member in tar:
+            file_hash = wanted.get(member.name)
+            if file_hash is not None and member.isfile() and store_blob(tar.extractfile(member), file_hash):
+                fetched.add(file_hash)
+    feeder.join()
+    stdout.channel.recv_exit_status()
+    return fetched
+
+def fetch_blob(sftp, file_hash):
+    """ Download one backup copy from the server into the local store, verifying it """
+    with sftp.open(blob_path(file_hash, REMOTE_BACKUP_DIR), 'rb') as src:
+        src.prefetch()
+        return store_blob(src, file_hash)
+
+def fetch_blobs(ssh_pool, hashes):
+    """
+    Download backup copies from the server into the local store, verifying each one.
+
+    More than one copy is fetched in a single tar stream; if that fails they are downloaded one by one.
+
+    :return: The set of hashes now in the local store.
+    """
+    if len(hashes) > 1:
+        try:
+            return download_blobs_bulk(ssh_pool, hashes)
+        except Exception as e:
+            logging.warning(f"Batched fetch of {len(hashes)} backup copies failed, fetching them one by one: {e}")
+    fetched = set()
+    for file_hash in hashes:
         try:
-            scp.get(remote_manifest_path, local_manifest_path)
-        except SCPException as e:
-            logging.error(f"Failed to fetch manifest: {e}")
-            # Additional error handling here
+            if ssh_pool.run(lambda sftp: fetch_blob(sftp, file_hash)):
+                fetched.add(file_hash)
+        except Exception as e:
+            logging.error(f"Failed to fetch backup copy {blob_path(file_hash, REMOTE_BACKUP_DIR)}: {e}")
+    return fetched
 
+def trim_local_store():
+    """ Evict the least recently used copies once the local store exceeds LOCAL_STORE_MAX_BYTES """
+    if not LOCAL_STORE_MAX_BYTES or not store_synced:
+        return  # Copies the server may not have yet are never evicted
+    blobs = []
+    total = 0
+    for shard in os.scandir(BACKUP_DIR):
+        if shard.is_dir(follow_symlinks=False) and len(shard.name) == 2:
+            for entry in os.scandir(shard.path):
+                stat_info = entry.stat(follow_symlinks=False)
+                blobs.append((stat_info.st_mtime_ns, stat_info.st_size, entry.path))
+                total += stat_info.st_size
+    if total <= LOCAL_STORE_MAX_BYTES:
+        return
+    evicted = 0
+    for _, size, path in sorted(blobs):
+        if total <= LOCAL_STORE_MAX_BYTES:
+            break
+        os.unlink(path)
+        total -= size
+        evicted += 1
+    logging.info(f"Evicted {evicted} least recently used backup copies from the local store, {total} bytes kept.")
 
-def monitor_files():
-    ssh_session = create_scp_session()
-    local_manifest_path = os.path.join(BACKUP_DIR, MANIFEST_FILE)
-    fetch_backup_manifest(ssh_session, local_manifest_path)
-    
-    backup_hashes = {}
-    backup_permissions = {}
-    backup_owners = {}  # Dictionary to hold UID and GID
-    with open(local_manifest_path, 'r') as manifest:
-        for line in manifest:
+def snapshot_manifest():
+    """
+    Copy the local manifest into a temporary file with SQLite's backup API.
+
+    The live database is in WAL mode and written by the monitor, so its file alone can be torn or
+    miss committed transactions. The snapshot is a single consistent file, and two snapshots of the
+    same content are byte-identical, so their hashes can be compared with the server's copy.
+
+    :return: The path of the snapshot, which the caller removes.
+    """
+    fd, snapshot_path = tempfile.mkstemp(dir=BACKUP_DIR, prefix='.tmp-')
+    os.close(fd)
+    source = sqlite3.connect(os.path.join(BACKUP_DIR, MANIFEST_FILE))
+    snapshot = sqlite3.connect(snapshot_path)
+    try:
+        source.backup(snapshot)
+        snapshot.execute('PRAGMA journal_mode=DELETE')  # Keep everything in the one file
+    except sqlite3.Error:
+        os.unlink(snapshot_path)
+        raise
+    finally:
+        snapshot.close()
+        source.close()
+    return snapshot_path
+
+def upload_manifest(sftp, snapshot_path):
+    """ Upload a snapshot of the local manifest, renaming it into place so the server never sees a partial copy """
+    sftp_makedirs(sftp, REMOTE_BACKUP_DIR, set())
+    remote_manifest_path = os.path.join(REMOTE_BACKUP_DIR, MANIFEST_FILE)
+    sftp.put(snapshot_path, remote_manifest_path + '.tmp')
+    sftp.posix_rename(remote_manifest_path + '.tmp', remote_manifest_path)
+
+def sync_backup_store(ssh_pool):
+    """
+    Upload to the SCP server only the backup blobs its manifest does not already reference.
+
+    Blobs go first and a snapshot of the manifest last, renamed into place, so every digest in the remote
+    manifest is backed by a complete blob and an interrupted sync is simply redone. Nothing but
+    one request is sent if the server's manifest is already identical. At least
+    BULK_TRANSFER_MIN_FILES missing blobs are streamed as one tar archive, falling back to
+    per-file uploads if that fails.
+    """
+    global store_synced
+    start = time.monotonic()
+    snapshot_path = snapshot_manifest()
+    try:
+        data = fetch_remote_manifest(ssh_pool, hash_file(snapshot_path))
+        if data is None:
+            store_synced = True
+            logging.info("The SCP server already holds the current manifest and every backup copy it references.")
+            return
+        conn = sqlite3.connect(snapshot_path)
+        try:
+            local = manifest_digests(conn)
+        finally:
+            conn.close()
+        remote = set()
+        if data:
+            try:
+                image = open_manifest_image(data)
+                remote = manifest_digests(image)
+                image.close()
+            except sqlite3.Error as e:
+                logging.warning(f"Remote manifest is unreadable, uploading the whole backup store: {e}")
+        missing = [digest.hex() for digest in local - remote]
+        evicted = [file_hash for file_hash in missing if not os.path.exists(blob_path(file_hash))]
+        if evicted:
+            logging.error(f"{len(evicted)} backup copies are neither on the server nor in the local store, their files cannot be restored.")
+            missing = [file_hash for file_hash in missing if file_hash not in evicted]
+        uploaded = None
+        if BULK_TRANSFER_MIN_FILES and len(missing) >= BULK_TRANSFER_MIN_FILES:
+            try:
+                uploaded = upload_blobs_bulk(ssh_pool, missing)
+            except Exception as e:
+                logging.warning(f"Bulk upload failed, falling back to per-file uploads: {e}")
+        if uploaded is None:
+            uploaded = ssh_pool.run(lambda sftp: upload_blobs(sftp, missing))
+        ssh_pool.run(lambda sftp: upload_manifest(sftp, snapshot_path))
+        store_synced = True
+        logging.info(f"Synced backup store to SCP server in {time.monotonic() - start:.1f}s: uploaded {len(missing)} of {len(local)} blobs ({uploaded} bytes), {len(local) - len(missing)} already on the server.")
+    finally:
+        os.unlink(snapshot_path)
+
+def validate_backup_store(manifest):
+    """
+    Check that the backup store left by a previous run can be trusted for a warm start.
+
+    Every backup copy must exist with the size recorded in its entry's stat fingerprint,
+    unless LOCAL_STORE_MAX_BYTES allows it to have been evicted, and a random sample of
+    WARM_START_SAMPLE copies is re-hashed.
+    """
+    records = []
+    for filepath in manifest:
+        record = manifest.get(filepath)
+        expected_size = FINGERPRINT_STRUCT.unpack(record.fingerprint)[0] if record.fingerprint else None
+        try:
+            size = os.stat(blob_path(record.hash)).st_size
+        except OSError:
+            if LOCAL_STORE_MAX_BYTES:
+                continue  # Evicted from the local store, the server keeps the copy
+            logging.error(f"Backup copy {blob_path(record.hash)} is missing, cannot warm start.")
+            return False
+        if expected_size is not None and size != expected_size:
+            logging.error(f"Backup copy {blob_path(record.hash)} has the wrong size, cannot warm start.")
+            return False
+        records.append(record)
+    sample = random.sample(records, min(WARM_START_SAMPLE, len(records)))
+    for record, current_hash in zip(sample, hash_files([blob_path(record.hash) for record in sample])):
+        if current_hash != record.hash:
+            logging.error(f"Backup copy {blob_path(record.hash)} does not match its hash, cannot warm start.")
+            return False
+    return True
+
+def clear_backup_store():
+    """ Remove every backup copy from the store, so a new baseline trusts nothing left on disk """
+    for entry in os.scandir(BACKUP_DIR):
+        if entry.is_dir(follow_symlinks=False) and len(entry.name) == 2:
+            shutil.rmtree(entry.path)
+
+def open_baseline_manifest():
+    """ Open the local manifest, discarding it if it is unreadable """
+    manifest_path = os.path.join(BACKUP_DIR, MANIFEST_FILE)
+    try:
+        return Manifest(manifest_path).load()
+    except (sqlite3.DatabaseError, RuntimeError) as e:
+        logging.error(f"Discarding unusable manifest {manifest_path}: {e}")
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(manifest_path + suffix):
+                os.unlink(manifest_path + suffix)
+        return Manifest(manifest_path)
+
+def backup_batch(manifest, filepaths, backed_up):
+    """
+    Back up a batch of files on the hashing pool and record them in the manifest.
+
+    :return: The number of new backup copies stored; the paths backed up are added to backed_up.
+    """
+    entries = []
+    stored = 0
+    for filepath, result in zip(filepaths, map_on_hash_pool(backup_file, filepaths)):
+        if result:
+            file_hash, stat_info, backup_path, newly_stored = result
+            file_permissions = stat_info.st_mode & 0o777
+            uid = stat_info.st_uid
+            gid = stat_info.st_gid
+            entries.append((filepath, file_hash, file_permissions, uid, gid, stat_fingerprint(stat_info)))
+            backed_up.add(filepath)
+            stored += newly_stored
+            logging.info(f"Backed up and hashed file: {filepath}, with permissions {oct(file_permissions)}, UID: {uid}, GID: {gid}. Backup path: {backup_path}")
+    manifest.put(entries)
+    return stored
+
+def backup_and_hash_files(ssh_pool, warm_start=False):
+    """
+    Back up the configured files into the store and record them in the manifest.
+
+    With warm_start, the store and manifest left by the previous run are reused if
+    validate_backup_store() accepts them: files no longer configured are dropped and only
+    files newly added to services.cfg are backed up. Files that changed or disappeared while
+    the monitor was stopped are not re-trusted; the first sweep restores them.
+    """
+    start = time.monotonic()
+    manifest = open_baseline_manifest()
+    if not len(manifest) and os.path.exists(os.path.join(BACKUP_DIR, LEGACY_MANIFEST_FILE)):
+        import_legacy_manifest(manifest, os.path.join(BACKUP_DIR, LEGACY_MANIFEST_FILE))
+    warm = warm_start and len(manifest) > 0 and validate_backup_store(manifest)
+    if not warm:
+        clear_backup_store()
+    covered = cfg_coverage(manifest.cfg_lines()) if warm else None
+    listed = set(read_cfg_roots(MONITOR_CFG))  # A file with its own line is always backed up, even below a covered directory
+    configured = set()
+    backed_up = set()
+    unexpected = []
+    stored = 0
+    batch = []
+    for filepath in read_cfg_file(MONITOR_CFG):  # The tree walk streams into the hashing pool one batch at a time
+        configured.add(filepath)
+        if warm and filepath in manifest:
+            continue
+        if covered and filepath not in listed and covered(filepath):
+            unexpected.append(filepath)  # Appeared while the monitor was stopped, under a line it already covered
+            continue
+        batch.append(filepath)
+        if len(batch) >= BASELINE_BATCH:
+            stored += backup_batch(manifest, batch, backed_up)
+            batch = []
+    stored += backup_batch(manifest, batch, backed_up)
+    for filepath in unexpected:
+        report_unexpected_file(filepath)
+    manifest.set_cfg_lines(path for path, _ in read_cfg_entries(MONITOR_CFG))
+
+    if warm:
+        # Entries below a configured directory stay even if the file is gone, so it gets restored, unless an exclude line now skips them
+        excluded = read_cfg_excludes(MONITOR_CFG)
+        for root in read_cfg_roots(MONITOR_CFG):
+            configured.update(filepath for filepath in manifest.under(root) if not (excluded and excluded_below(excluded, root, filepath)))
+        stale = set(manifest).difference(configured)
+    else:
+        stale = set(manifest).difference(backed_up)
+    manifest.remove(stale)
+    total = len(manifest)
+    manifest.close()
+    if warm:
+        logging.info(f"Warm start reused the previous baseline of {total - len(backed_up)} files, dropped {len(stale)} and backed up {len(backed_up)} new files in {time.monotonic() - start:.1f}s.")
+    logging.info(f"Baseline of {len(backed_up)} files stored as {stored} new backup copies, {len(backed_up) - stored} deduplicated.")
+
+    try:
+        sync_backup_store(ssh_pool)
+    except Exception as e:
+        logging.warning(f"Cannot upload the baseline to the SCP server, it stays local until the server is reachable: {e}")
+    journal.record('baseline', files=total, new_copies=stored, synced=store_synced)
+    trim_local_store()
+
+
+class Journal:
+    """
+    Append-only record of tamper events, restores and baselines, one JSON object per line.
+
+    Events are written locally whatever the state of the connection; the Uplink ships the file to
+    the server and empties it with compact() once everything in it was acknowledged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, event, **fields):
+        line = json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'event': event, **fields})
+        with self.lock, open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+    def compact(self, shipped):
+        """ Empty the journal if its first shipped bytes are all it holds; returns True if it did """
+        with self.lock:
+            try:
+                if os.path.getsize(self.path) != shipped:
+                    return False
+            except FileNotFoundError:
+                return False
+            open(self.path, 'w').close()
+            return True
+
+journal = Journal(JOURNAL_FILE)
+
+class ShippedFile:
+    """
+    A local append-only file mirrored to the server by sending only the bytes added since the last shipment.
+
+    New bytes are compressed in SHIP_BATCH-sized gzip members and appended to remote_path, which stays
+    a valid gzip file. The shipped offset and the inode it belongs to are kept in <path>.offset and
+    only advanced once the server accepted the data; when RotatingFileHandler rolls the file over,
+    the rest of <path>.1 is shipped before starting on the new file.
+    """
+
+    def __init__(self, path, remote_path):
+        self.path = path
+        self.remote_path = remote_path
+        self.offset_path = path + '.offset'
+        self.inode, self.offset = self.load_offset()
+        self.data_bytes = 0
+        self.wire_bytes = 0
+
+    def load_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                inode, offset = f.read().split()
+            return int(inode), int(offset)
+        except (OSError, ValueError):
+            return None, 0
+
+    def save_offset(self):
+        with open(self.offset_path, 'w') as f:
+            f.write(f"{self.inode} {self.offset}\n")
+
+    def pending(self):
+        """ Return (path, inode, offset, size) spans not yet shipped, oldest first """
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+        if self.inode in (None, current.st_ino):
+            if current.st_size < self.offset:
+                self.offset = 0  # Truncated in place
+            return [(self.path, current.st_ino, self.offset, current.st_size)]
+        spans = []
+        try:
+            rotated = os.stat(self.path + '.1')
+            if rotated.st_ino == self.inode:
+                spans.append((self.path + '.1', rotated.st_ino, self.offset, rotated.st_size))
+        except FileNotFoundError:
+            pass
+        if not spans:
+            logging.warning(f"{self.path} rotated more than once since the last shipment, part of it was not shipped.")
+        spans.append((self.path, current.st_ino, 0, current.st_size))
+        return spans
+
+    def ship(self, ssh_pool):
+        """ Send everything written since the last shipment """
+        for path, inode, offset, size in self.pending():
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                while offset < size:
+                    data = f.read(min(SHIP_BATCH, size - offset))
+                    if not data:
+                        break
+                    member = gzip.compress(data)
+                    ssh_pool.run(lambda sftp: self.append(sftp, member))
+                    offset += len(data)
+                    self.data_bytes += len(data)
+                    self.wire_bytes += len(member)
+                    self.inode, self.offset = inode, offset
+                    self.save_offset()
+            if (self.inode, self.offset) != (inode, offset):
+                self.inode, self.offset = inode, offset
+                self.save_offset()
+
+    def append(self, sftp, member):
+        with sftp.open(self.remote_path, 'a') as remote:
+            remote.write(member)
+
+class Uplink(threading.Thread):
+    """
+    Sends the server everything the agent owes it, off the monitoring thread, and catches up after outages.
+
+    Every SHIP_INTERVAL seconds, or when notified, it uploads the baseline if sync_backup_store()
+    has not succeeded yet, then ships what was added to the monitoring log and the journal. While
+    the server is unreachable all of it stays local; the first successful round replays the backlog
+    in compressed batches from the last acknowledged offsets.
+    """
+
+    def __init__(self, ssh_pool):
+        super().__init__(name='uplink', daemon=True)
+        self.ssh_pool = ssh_pool
+        remote_dir = os.path.join(SCP_REMOTE_PATH, local_ip)
+        self.log = ShippedFile(log_file, os.path.join(remote_dir, log_file + '.gz'))
+        self.journal = ShippedFile(JOURNAL_FILE, os.path.join(remote_dir, JOURNAL_FILE + '.gz'))
+        self.wake = threading.Event()
+        self.stopping = False
+        self.failing = False
+
+    def catch_up(self):
+        if not store_synced:
+            sync_backup_store(self.ssh_pool)
+            journal.record('baseline-synced')
+        self.log.ship(self.ssh_pool)
+        self.journal.ship(self.ssh_pool)
+        if self.journal.offset >= JOURNAL_COMPACT_BYTES and journal.compact(self.journal.offset):
+            self.journal.offset = 0
+            self.journal.save_offset()
+
+    def run(self):
+        while True:
+            self.wake.wait(SHIP_INTERVAL)
+            self.wake.clear()
+            try:
+                self.catch_up()
+                if self.failing:
+                    logging.info("SCP server reachable again, baseline, log and journal caught up.")
+                self.failing = False
+            except Exception as e:
+                # Logged once per outage so the warning itself does not keep the log growing
+                if not self.failing:
+                    logging.warning(f"Cannot reach SCP server, keeping the log and journal locally until it is back: {e}")
+                self.failing = True
+            if self.stopping:
+                return
+
+    def notify(self):
+        """ Ship as soon as possible instead of waiting for the next interval """
+        self.wake.set()
+
+    def stop(self):
+        """ Ship what is left and wait for the thread to finish """
+        self.stopping = True
+        self.wake.set()
+        self.join()
+        for shipped in (self.log, self.journal):
+            logging.info(f"Shipped {shipped.data_bytes} bytes of {shipped.path} as {shipped.wire_bytes} compressed bytes.")
+
+def fetch_backup_manifest(ssh_pool, local_manifest_path):
+    """
+    Replace the local manifest with the server's copy if they differ.
+
+    One request compares the two; a differing copy is parsed in memory and written into the local
+    database with SQLite's backup API, so an unreadable download never touches the local manifest.
+    """
+    local_hash = None
+    if os.path.exists(local_manifest_path):
+        snapshot_path = snapshot_manifest()
+        local_hash = hash_file(snapshot_path)  # Hashed the way upload_manifest() wrote the server's copy
+        os.unlink(snapshot_path)
+    try:
+        data = fetch_remote_manifest(ssh_pool, local_hash)
+    except Exception as e:
+        logging.error(f"Failed to fetch manifest: {e}")
+        return
+    if data is None:
+        logging.info("Local manifest matches the copy on the SCP server.")
+        return
+    if not data:
+        logging.error(f"Remote manifest file does not exist: {os.path.join(REMOTE_BACKUP_DIR, MANIFEST_FILE)}")
+        return
+    try:
+        image = open_manifest_image(data)
+    except sqlite3.Error as e:
+        logging.error(f"Remote manifest is unreadable, keeping the local copy: {e}")
+        return
+    local = sqlite3.connect(local_manifest_path)
+    try:
+        image.backup(local)
+    finally:
+        local.close()
+        image.close()
+    logging.info(f"Local manifest replaced by the copy on the SCP server ({len(data)} bytes).")
+
+
+class FileRecord:
+    """ In-memory manifest entry: binary digest, mode/uid/gid packed into one integer, packed stat fingerprint """
+    __slots__ = ('digest', 'meta', 'fingerprint')
+
+    def __init__(self, digest, permissions, uid, gid, fingerprint):
+        self.digest = digest
+        self.meta = (uid << 44) | (gid << 12) | permissions
+        self.fingerprint = fingerprint
+
+    @property
+    def hash(self):
+        return self.digest.hex()
+
+    @property
+    def permissions(self):
+        return self.meta & 0o7777
+
+    @property
+    def uid(self):
+        return self.meta >> 44
+
+    @property
+    def gid(self):
+        return (self.meta >> 12) & 0xffffffff
+
+class Manifest:
+    """
+    Backup manifest stored in SQLite (WAL mode) and mirrored in memory.
+
+    Entries are written individually or in batches instead of rewriting the whole manifest,
+    and fingerprint refreshes from the monitor are buffered until flush(). In memory, entries
+    are FileRecords grouped per directory, so each directory string is held once instead of
+    once per file path.
+    """
+
+    def __init__(self, manifest_path):
+        self.path = manifest_path
+        self.conn = sqlite3.connect(manifest_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > MANIFEST_SCHEMA_VERSION:
+            self.conn.close()
+            raise RuntimeError(f"Manifest {manifest_path} has schema version {version}, this version supports up to {MANIFEST_SCHEMA_VERSION}")
+        if version < 1:
+            with self.conn:
+                self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    hash BLOB NOT NULL,
+                    permissions INTEGER NOT NULL,
+                    uid INTEGER NOT NULL,
+                    gid INTEGER NOT NULL,
+                    fingerprint BLOB
+                ) WITHOUT ROWID""")
+        if version < 2:
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS cfg_lines (line TEXT PRIMARY KEY) WITHOUT ROWID')
+                self.conn.execute(f'PRAGMA user_version = {MANIFEST_SCHEMA_VERSION}')
+        self.dirs = {}  # Directory -> {file name -> FileRecord}
+        self.count = 0
+        self.dirty = set()  # Paths whose fingerprint changed since the last flush()
+
+    def load(self):
+        """ Read every entry into memory """
+        for filepath, digest, permissions, uid, gid, fingerprint in self.conn.execute('SELECT * FROM files'):
+            self.remember(filepath, FileRecord(digest, permissions, uid, gid, fingerprint))
+        return self
+
+    def remember(self, filepath, record):
+        directory, name = os.path.split(filepath)
+        entries = self.dirs.get(directory)
+        if entries is None:
+            entries = self.dirs[sys.intern(directory)] = {}
+        if name not in entries:
+            self.count += 1
+        entries[name] = record
+
+    def get(self, filepath):
+        """ FileRecord for filepath, or None if it is not in the manifest """
+        directory, name = os.path.split(filepath)
+        entries = self.dirs.get(directory)
+        return entries.get(name) if entries is not None else None
+
+    def __contains__(self, filepath):
+        return self.get(filepath) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for directory, entries in self.dirs.items():
+            for name in entries:
+                yield os.path.join(directory, name)
+
+    def put(self, entries):
+        """ Insert or update (path, hash, permissions, uid, gid, fingerprint) entries in one transaction """
+        rows = []
+        for filepath, file_hash, permissions, uid, gid, fingerprint in entries:
+            digest = bytes.fromhex(file_hash)
+            self.remember(filepath, FileRecord(digest, permissions, uid, gid, fingerprint))
+            self.dirty.discard(filepath)
+            rows.append((filepath, digest, permissions, uid, gid, fingerprint))
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def remove(self, filepaths):
+        """ Drop entries in one transaction """
+        filepaths = list(filepaths)
+        for filepath in filepaths:
+            directory, name = os.path.split(filepath)
+            entries = self.dirs.get(directory)
+            if entries is not None and entries.pop(name, None) is not None:
+                self.count -= 1
+                if not entries:
+                    del self.dirs[directory]
+            self.dirty.discard(filepath)
+        with self.conn:
+            self.conn.executemany('DELETE FROM files WHERE path = ?', ((filepath,) for filepath in filepaths))
+
+    def set_fingerprint(self, filepath, fingerprint):
+        """ Record the fingerprint a file was last verified with; written out by flush() """
+        record = self.get(filepath)
+        if record is not None and record.fingerprint != fingerprint:
+            record.fingerprint = fingerprint
+            self.dirty.add(filepath)
+
+    def flush(self):
+        """ Write buffered fingerprint changes in one transaction """
+        if not self.dirty:
+            return
+        rows = []
+        for filepath in self.dirty:
+            record = self.get(filepath)
+            if record is not None:
+                rows.append((record.fingerprint, filepath))
+        with self.conn:
+            self.conn.executemany('UPDATE files SET fingerprint = ? WHERE path = ?', rows)
+        self.dirty.clear()
+
+    def cfg_lines(self):
+        """ The services.cfg paths and !exclude lines of the baseline, empty for manifests written before they were kept """
+        return {row[0] for row in self.conn.execute('SELECT line FROM cfg_lines')}
+
+    def set_cfg_lines(self, lines):
+        with self.conn:
+            self.conn.execute('DELETE FROM cfg_lines')
+            self.conn.executemany('INSERT OR IGNORE INTO cfg_lines VALUES (?)', ((line,) for line in lines))
+
+    def under(self, directory):
+        """ Paths of the entries below directory, answered from the primary key index """
+        prefix = directory.rstrip('/') + '/'
+        # '0' is the character right after '/', so this range covers exactly the paths starting with prefix
+        cursor = self.conn.execute('SELECT path FROM files WHERE path >= ? AND path < ?', (prefix, prefix[:-1] + '0'))
+        return [row[0] for row in cursor]
+
+    def close(self):
+        """ Flush, fold the WAL back into the database file and close it """
+        self.flush()
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.conn.close()
+
+def import_legacy_manifest(manifest, csv_path):
+    """
+    Load a comma-separated manifest written by older versions into manifest.
+
+    Older versions kept each backup as a flat copy named after the file in BACKUP_DIR. Each copy
+    is moved into the content-addressed store if it still matches its recorded hash; entries
+    without a matching copy are left out so the baseline backs their files up again.
+    """
+    entries = []
+    with open(csv_path, 'r') as f:
+        for line in f:
             parts = line.strip().split(',')
             filepath, file_hash = parts[0], parts[1]
             permissions, uid, gid = map(int, parts[2:5])  # Correctly extract and convert permissions, UID, and GID
-            backup_hashes[filepath] = file_hash
-            backup_permissions[filepath] = permissions
-            backup_owners[filepath] = (uid, gid)  # Store UID and GID as a tuple
+            fingerprint = FINGERPRINT_STRUCT.pack(*map(int, parts[5:10])) if len(parts) >= 10 else None
+            backup_path = blob_path(file_hash)
+            if not os.path.exists(backup_path):
+                legacy_copy = os.path.join(BACKUP_DIR, os.path.basename(filepath))
+                if not os.path.isfile(legacy_copy) or hash_file(legacy_copy) != file_hash:
+                    logging.warning(f"Legacy backup of {filepath} is missing or does not match its recorded hash, backing the file up again.")
+                    continue
+                os.makedirs(os.path.dirname(backup_path), exist_ok=True)
+                os.replace(legacy_copy, backup_path)
+            entries.append((filepath, file_hash, permissions, uid, gid, fingerprint))
+    manifest.put(entries)
+    os.replace(csv_path, csv_path + '.imported')  # Imported once; kept for reference
+    logging.info(f"Imported {len(entries)} entries from legacy manifest {csv_path}, backup copies moved into the store.")
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+FILE_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_DELETE_SELF | IN_MOVE_SELF
+DIR_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len, followed by len bytes of name
+
+class InotifyWatcher:
+    """
+    Minimal inotify(7) binding over ctypes.
+
+    Monitored files are watched for content and metadata changes and their parent directories
+    for entries being created, deleted or renamed, so a file that is replaced or recreated is
+    still seen after the kernel drops its own watch.
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)  # AttributeError without inotify
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+        self.watches = {}  # Watch descriptor -> watched path
+        self.wds = {}  # Watched path -> watch descriptor
+        self.masks = {}  # Path -> event mask it was watched with
+        self.lost = set()  # Paths whose watch was dropped by the kernel
+        self.full = False  # Set once the inotify watch limit has been hit
+
+    def add_watch(self, path, mask):
+        """ Watch path for the events in mask, returning False if it cannot be watched """
+        self.masks[path] = mask
+        if self.full:
+            return False
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            if ctypes.get_errno() == errno.ENOSPC:
+                self.full = True
+                logging.warning("inotify watch limit reached (fs.inotify.max_user_watches), polling the remaining files.")
+            self.lost.add(path)
+            return False
+        self.watches[wd] = path
+        self.wds[path] = wd
+        self.lost.discard(path)
+        return True
+
+    def rearm(self):
+        """ Try to watch again every path whose watch was dropped, e.g. after a delete and restore """
+        for path in list(self.lost):
+            self.add_watch(path, self.masks[path])
+
+    def read_events(self, timeout):
+        """
+        Wait up to timeout seconds for events.
+
+        :return: A (paths, overflow) tuple with the paths that changed and whether the kernel event queue overflowed.
+        """
+        paths = set()
+        overflow = False
+        if not self.poller.poll(max(int(timeout * 1000), 0)):
+            return paths, overflow
+        time.sleep(INOTIFY_SETTLE)
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                path = self.watches.get(wd)
+                if path is None:
+                    continue
+                paths.add(os.path.join(path, os.fsdecode(name)) if name else path)
+                if mask & IN_IGNORED:
+                    del self.watches[wd]
+                    if self.wds.get(path) == wd:
+                        del self.wds[path]
+                        self.lost.add(path)
+        return paths, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+def start_watcher(filepaths):
+    """ Watch the given files and their parent directories, or return None if inotify is unavailable """
+    try:
+        watcher = InotifyWatcher()
+    except (OSError, AttributeError) as e:
+        logging.warning(f"inotify is unavailable, falling back to polling by the scan scheduler: {e}")
+        return None
+    for directory in {os.path.dirname(filepath) for filepath in filepaths}:
+        watcher.add_watch(directory, DIR_EVENTS)
+    for filepath in filepaths:
+        watcher.add_watch(filepath, FILE_EVENTS)
+    watched = sum(1 for filepath in filepaths if filepath in watcher.wds)
+    logging.info(f"inotify is watching {watched} of {len(filepaths)} files, the rest are polled by the scan scheduler.")
+    return watcher
+
+def monitor_files(ssh_pool):
+    local_manifest_path = os.path.join(BACKUP_DIR, MANIFEST_FILE)
+    if store_synced:
+        fetch_backup_manifest(ssh_pool, local_manifest_path)  # Otherwise the server's copy predates the local baseline
+    
+    manifest = Manifest(local_manifest_path).load()
 
+    pin_files(ssh_pool, manifest)
+    watcher = start_watcher(list(manifest)) if USE_INOTIFY else None
+    uplink = Uplink(ssh_pool)
+    uplink.start()
+    remote_restorer = RemoteRestorer(ssh_pool)
+    remote_restorer.start()
+    pipeline = CheckPipeline(manifest, remote_restorer)
+    check_files(pipeline, list(manifest), manifest)  # Catch changes made while the monitor was not running
+    tree = TreeSnapshot([root for root in read_cfg_roots(MONITOR_CFG) if os.path.isdir(root)], read_cfg_excludes(MONITOR_CFG))
+    scheduler = ScanScheduler(manifest, read_cfg_tiers(MONITOR_CFG), time.monotonic())
+    logging.info(f"Scan tiers: {scheduler.describe()}.")
+    sweep_budget = SweepBudget(SWEEP_BYTES_PER_SECOND, SWEEP_HASHES_PER_SECOND)
+    throttled = {}  # File -> (full_rehash, tier, due time), for scheduled checks deferred by the sweep budget
+    checked = skipped = hashed = left = 0
+    next_report = time.monotonic() + MONITOR_INTERVAL
     while running:
-        for filepath, expected_hash in backup_hashes.items():
-            permissions = backup_permissions[filepath]
-            uid, gid = backup_owners[filepath]  # Extract UID and GID
-            if os.path.exists(filepath):
-                current_hash = hash_file(filepath)
-                if current_hash != expected_hash:
-                    logging.warning(f"File changed or corrupted: {filepath}")
-                    restore_file_from_backup(ssh_session, filepath, expected_hash, permissions, uid, gid)
+        apply_remote_restores(remote_restorer, manifest)
+        pipeline.drain()
+        now = time.monotonic()
+        due = scheduler.take_due(now)
+        if due or throttled:
+            # Deferred files go first; exempt tiers are checked at full speed, the rest within the sweep budget
+            exempt, background = {}, throttled
+            for filepath, full_rehash, tier, when in due:
+                # Watched files are left to inotify, except for their periodic full rehash and while a failed restore left them without a fingerprint
+                if full_rehash or not watcher or filepath not in watcher.wds or manifest.get(filepath).fingerprint is None:
+                    if tier in SWEEP_EXEMPT_TIERS:
+                        exempt[filepath] = (full_rehash, tier, when)
+                    else:
+                        background.setdefault(filepath, (full_rehash, tier, when))  # A deferred file keeps its first due time
+                else:
+                    left += 1
+            checked += len(due)
+            for filepaths, budget in ((exempt, None), (background, sweep_budget)):
+                paranoid = {filepath for filepath, (full_rehash, _, _) in filepaths.items() if full_rehash}
+                due_skipped, due_hashed, deferred = check_files(pipeline, list(filepaths), manifest, force_hash=paranoid, budget=budget)
+                skipped += due_skipped
+                hashed += due_hashed
+            throttled = {filepath: background[filepath] for filepath in deferred}
+            for filepath in background.keys() - throttled.keys():
+                _, tier, when = background[filepath]
+                scheduler.record_lateness(tier, now - when)  # Time spent waiting for the sweep budget counts towards detection latency
+        if now >= next_report:
+            diff_monitored_trees(pipeline, tree, manifest)
+            logging.info(f"Checked {checked} files in the last {MONITOR_INTERVAL} seconds: {skipped} stat-skipped, {hashed} hashed, {left} left to inotify, {len(throttled)} waiting for the sweep budget, {tree.listed} of {len(tree.dirs)} directories listed. Worst-case detection latency: {scheduler.report()}.")
+            logging.info(f"Check pipeline: {pipeline.report()}.")
+            manifest.flush()
+            uplink.notify()
+            checked = skipped = hashed = left = 0
+            next_report = now + MONITOR_INTERVAL
+        wait = min(scheduler.next_due() or next_report, next_report) - time.monotonic()
+        if throttled:
+            wait = min(wait, sweep_budget.wait_time(time.monotonic()))
+        if pipeline.pending():
+            wait = min(wait, PIPELINE_POLL)
+        if watcher is None:
+            time.sleep(max(wait, 0))
+            continue
+        changed, overflow = watcher.read_events(wait)
+        if overflow:
+            logging.warning("inotify event queue overflowed, checking every watched file.")
+            check_files(pipeline, [filepath for filepath in watcher.wds if filepath in manifest], manifest)
+        changed = {filepath for filepath in changed if filepath in manifest}  # A set, as check_files() looks each file up in force_hash
+        check_files(pipeline, changed, manifest, force_hash=changed)
+        manifest.flush()
+        watcher.rearm()
+
+    if watcher:
+        watcher.close()
+    pipeline.close()
+    if sweep_pool:
+        sweep_pool.shutdown()
+    remote_restorer.stop()
+    apply_remote_restores(remote_restorer, manifest)
+    manifest.close()
+    logging.info(f"Restores by tier: {describe_restore_stats()}.")
+    uplink.stop()
+
+
+class RemoteRestorer(threading.Thread):
+    """
+    Restores files whose content only the server still has, off the monitoring thread.
+
+    The CheckPipeline hands over what the local tiers could not restore. Queued files are merged
+    into one batch, their copies fetched with fetch_blobs() and the files restored from the local
+    store, so a slow or unreachable server delays only these restores, never local detection.
+    Outcomes go back through collect() because the manifest belongs to the monitoring thread.
+    """
+
+    def __init__(self, ssh_pool):
+        super().__init__(name='remote-restorer', daemon=True)
+        self.ssh_pool = ssh_pool
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.pending = set()  # Files queued and not yet collected, only used by the monitoring thread
+
+    def submit(self, records):
+        """ Queue (filepath, record) pairs for restore from the server, skipping files already queued """
+        batch = [(filepath, record) for filepath, record in records if filepath not in self.pending]
+        self.pending.update(filepath for filepath, _ in batch)
+        if batch:
+            self.requests.put(batch)
+        return len(batch)
+
+    def collect(self):
+        """ Return (filepath, restored) for every restore finished since the last call """
+        done = []
+        while True:
+            try:
+                filepath, restored = self.results.get_nowait()
+            except queue.Empty:
+                return done
+            self.pending.discard(filepath)
+            done.append((filepath, restored))
+
+    def run(self):
+        while True:
+            batch = self.requests.get()
+            if batch is None:
+                return
+            stopping = False
+            while not stopping:
+                try:
+                    more = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                stopping = more is None
+                batch.extend(more or ())
+            self.restore(batch)
+            if stopping:
+                return
+
+    def restore(self, batch):
+        start = time.monotonic()
+        fetched = fetch_blobs(self.ssh_pool, {record.hash for _, record in batch})
+        fetch_time = time.monotonic() - start
+        restored = 0
+        for filepath, record in batch:
+            if record.hash in fetched:
+                ok = restore_file_from_store(filepath, record, tier='remote')
+            else:
+                ok = False
+                restore_stats['remote']['misses'] += 1
+            self.results.put((filepath, ok))
+            journal.record('restore', path=filepath, tier='remote', restored=bool(ok))
+            restored += ok
+        trim_local_store()
+        logging.info(f"Remote restore batch: {restored} of {len(batch)} files restored, {len(fetched)} backup copies fetched from the server in {fetch_time:.2f}s, {time.monotonic() - start:.2f}s in total.")
+
+    def stop(self):
+        """ Finish the queued restores and wait for the thread; remote calls are bounded by SSH_TIMEOUT """
+        self.requests.put(None)
+        self.join()
+
+def apply_remote_restores(remote_restorer, manifest):
+    """ Record the outcome of finished remote restores; files that failed lose their fingerprint, so each scheduled check of their tier retries them """
+    for filepath, restored in remote_restorer.collect():
+        manifest.set_fingerprint(filepath, file_fingerprint(filepath) if restored else None)
+
+def restore_file_locally(filepath, record):
+    """ Restore a file from the first local tier holding a verified copy; returns the tier's name, or None """
+    if pinned_store.get(record.hash) is not None:
+        restored = restore_file_from_pinned(filepath, record)
+        restore_stats['pinned']['hits' if restored else 'misses'] += 1
+        if restored:
+            return 'pinned'
+    if restore_file_from_memory(filepath, record):
+        return 'memory'
+    if restore_file_from_store(filepath, record):
+        return 'local'
+    return None
+
+def check_files(pipeline, filepaths, manifest, force_hash=(), budget=None):
+    """
+    The stat stage of the CheckPipeline: verify files against the manifest, restoring any file that is missing or changed.
+
+    A file is only rehashed when its stat fingerprint changed since it was last verified or
+    it is listed in force_hash. Files the pipeline is already hashing or restoring are checked
+    again once it is done with them, so a change made meanwhile is not lost. Hashes are
+    compared and restores applied later by pipeline.drain(). A file whose fingerprint changed
+    is hashed at once, like an inotify event. With a SweepBudget, forced rehashes of unchanged
+    files only run as it admits them, on the demoted sweep thread, and the rest are deferred.
+
+    :return: A (stat_skipped, queued_for_hashing, deferred) tuple: two file counts and the list of deferred files.
+    """
+    start = time.monotonic()
+    stalled = pipeline.stalled['stat']
+    skipped = 0
+    hashed = 0
+    deferred = []
+    for filepath in filepaths:
+        if pipeline.busy_with(filepath):
+            pipeline.recheck_later(filepath, filepath in force_hash)
+            continue
+        fingerprint = file_fingerprint(filepath)
+        if fingerprint is None:
+            logging.warning(f"File deleted or moved: {filepath}")
+            journal.record('tamper', path=filepath, change='deleted', expected=manifest.get(filepath).hash)
+            pipeline.restore(filepath, 'stat')
+            skipped += 1
+        elif fingerprint != manifest.get(filepath).fingerprint:
+            pipeline.hash(filepath, fingerprint)  # Likely tampered, so never held back by the sweep budget
+            hashed += 1
+        elif filepath in force_hash:
+            if budget is not None and not budget.admit(FINGERPRINT_STRUCT.unpack(fingerprint)[0], time.monotonic()):
+                deferred.append(filepath)
+                continue
+            pipeline.hash(filepath, fingerprint, background=budget is not None)
+            hashed += 1
+        else:
+            skipped += 1
+    pipeline.counted('stat', len(filepaths), time.monotonic() - start - (pipeline.stalled['stat'] - stalled))
+    return skipped, hashed, deferred
+
+class CheckPipeline:
+    """
+    Verification as stages connected by bounded queues, so detection goes on while files are hashed and restored.
+
+    check_files() is the stat stage and hands files to rehash to the hashing threads. Their
+    results are compared by drain() on the monitoring thread, which owns the manifest; a
+    restore thread tries the local tiers for tampered files and those none of them hold are
+    handed to the remote_restorer. At most PIPELINE_HASH_DEPTH hashes and PIPELINE_RESTORE_DEPTH
+    restores are in flight; a stage that finds the next one full waits for a slot, so one
+    huge file or slow restore only holds up its own slot.
+    """
+
+    STAGES = ('stat', 'hash', 'compare', 'restore')
+
+    def __init__(self, manifest, remote_restorer):
+        self.manifest = manifest
+        self.remote_restorer = remote_restorer
+        self.hashed = queue.Queue()
+        self.restored = queue.Queue()
+        self.hash_slots = threading.Semaphore(PIPELINE_HASH_DEPTH)  # Released once the comparator has taken the result
+        self.restore_slots = threading.Semaphore(PIPELINE_RESTORE_DEPTH)  # Released by the restore thread
+        self.restorer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='restore')
+        self.in_flight = set()  # Files being hashed or restored, only used by the monitoring thread
+        self.recheck = {}  # File -> force_hash, for files to check again once they leave the pipeline
+        self.rechecking = False
+        self.depth = dict.fromkeys(('hash', 'restore'), 0)
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.files = dict.fromkeys(self.STAGES, 0)
+        self.seconds = dict.fromkeys(self.STAGES, 0.0)  # Time spent working in each stage
+        self.stalled = dict.fromkeys(self.STAGES, 0.0)  # Time each stage waited for a slot in the next
+        self.max_depth = dict(self.depth)
+        self.since = time.monotonic()
+
+    def busy_with(self, filepath):
+        return filepath in self.in_flight or filepath in self.remote_restorer.pending
+
+    def recheck_later(self, filepath, force_hash):
+        """ Check a file again once the hash or restore in flight for it has been applied """
+        self.recheck[filepath] = self.recheck.get(filepath, False) or force_hash
+
+    def pending(self):
+        return self.depth['hash'] or self.depth['restore']
+
+    def counted(self, stage, files, seconds):
+        self.files[stage] += files
+        self.seconds[stage] += seconds
+
+    def hash(self, filepath, fingerprint, background=False):
+        """ Queue a file for hashing, comparing finished hashes while waiting for a free slot """
+        start = time.monotonic()
+        while not self.hash_slots.acquire(timeout=PIPELINE_POLL):
+            self.drain()
+        self.stalled['stat'] += time.monotonic() - start
+        self.in_flight.add(filepath)
+        self.depth['hash'] += 1
+        self.max_depth['hash'] = max(self.max_depth['hash'], self.depth['hash'])
+        get_hash_executor(background).submit(self.hash_job, filepath, fingerprint)
+
+    def hash_job(self, filepath, fingerprint):
+        start = time.monotonic()
+        try:
+            current_hash = hash_file(filepath)
+        except Exception as e:
+            logging.error(f"Failed to hash {filepath}: {e}")
+            current_hash = None
+        self.hashed.put((filepath, fingerprint, current_hash, time.monotonic() - start))
+
+    def restore(self, filepath, stage='compare'):
+        """ Queue a missing or changed file for restore from the given stage, waiting for a free slot """
+        start = time.monotonic()
+        self.restore_slots.acquire()
+        self.stalled[stage] += time.monotonic() - start
+        self.in_flight.add(filepath)
+        self.depth['restore'] += 1
+        self.max_depth['restore'] = max(self.max_depth['restore'], self.depth['restore'])
+        self.restorer.submit(self.restore_job, filepath, self.manifest.get(filepath))
+
+    def restore_job(self, filepath, record):
+        start = time.monotonic()
+        try:
+            tier = restore_file_locally(filepath, record)
+        except Exception as e:
+            logging.error(f"Failed to restore {filepath}: {e}")
+            tier = None
+        self.restored.put((filepath, tier, file_fingerprint(filepath) if tier else None, time.monotonic() - start))
+        self.restore_slots.release()
+
+    def drain(self):
+        """ The comparator: apply every finished hash and restore, queueing restores for files that do not match and rechecks for files that are done """
+        while True:
+            try:
+                filepath, fingerprint, current_hash, seconds = self.hashed.get_nowait()
+            except queue.Empty:
+                break
+            self.hash_slots.release()
+            self.in_flight.discard(filepath)
+            self.depth['hash'] -= 1
+            self.counted('hash', 1, seconds)
+            start = time.monotonic()
+            record = self.manifest.get(filepath)
+            if current_hash == record.hash:
+                if file_fingerprint(filepath) == fingerprint:
+                    self.manifest.set_fingerprint(filepath, fingerprint)
+                else:
+                    self.recheck_later(filepath, True)  # Changed while it was hashed, so the hash may not cover the change
+            else:
+                logging.warning(f"File changed or corrupted: {filepath}")
+                journal.record('tamper', path=filepath, change='modified', expected=record.hash, found=current_hash)
+                self.restore(filepath)
+            self.counted('compare', 1, time.monotonic() - start)
+        while True:
+            try:
+                filepath, tier, fingerprint, seconds = self.restored.get_nowait()
+            except queue.Empty:
+                break
+            self.in_flight.discard(filepath)
+            self.depth['restore'] -= 1
+            self.counted('restore', 1, seconds)
+            if tier:
+                journal.record('restore', path=filepath, tier=tier, restored=True)
+            else:
+                self.remote_restorer.submit([(filepath, self.manifest.get(filepath))])
+            self.manifest.set_fingerprint(filepath, fingerprint)
+        while not self.rechecking:  # check_files() may drain again while waiting for a hash slot
+            ready = [filepath for filepath in self.recheck if not self.busy_with(filepath)]
+            if not ready:
+                break
+            forced = {filepath for filepath in ready if self.recheck.pop(filepath)}
+            self.rechecking = True
+            try:
+                check_files(self, ready, self.manifest, force_hash=forced)
+            finally:
+                self.rechecking = False
+
+    def report(self):
+        """ Files, throughput, busy and stalled time per stage and the deepest queues since the last report """
+        elapsed = max(time.monotonic() - self.since, 1e-9)
+        stages = ', '.join(f"{stage} {self.files[stage]} files ({self.files[stage] / elapsed:.1f}/s, {self.seconds[stage]:.2f}s busy, {self.stalled[stage]:.2f}s stalled)" for stage in self.STAGES)
+        depths = ', '.join(f"{stage} {depth}" for stage, depth in self.max_depth.items())
+        self.reset_counters()
+        return f"{stages}; deepest queues: {depths}"
+
+    def close(self):
+        """ Wait for the hashes and restores in flight and apply them """
+        while self.pending():
+            self.drain()
+            time.sleep(PIPELINE_POLL)
+        self.restorer.shutdown()
+
+class TokenBucket:
+    """
+    Allows rate units per second on average, in bursts of up to one second's worth (0 = unlimited).
+
+    A grant may overdraw the bucket, so a file larger than the burst still gets hashed;
+    the debt is paid off before the next grant.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def ready(self, now):
+        if self.rate:
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens >= 0
+
+    def spend(self, amount):
+        if self.rate:
+            self.tokens -= amount
+
+    def wait_time(self, now):
+        """ Seconds until the bucket grants again """
+        return 0 if self.ready(now) else -self.tokens / self.rate
+
+class SweepBudget:
+    """ Bytes and files per second that scheduled full rehashes may read, so verification is spread out instead of saturating the disk """
+
+    def __init__(self, bytes_per_second, hashes_per_second):
+        self.buckets = (TokenBucket(bytes_per_second), TokenBucket(hashes_per_second))
+
+    def admit(self, size, now):
+        """ Spend the budget for hashing a file of size bytes, or return False if it is used up """
+        bytes_bucket, hashes_bucket = self.buckets
+        if not (bytes_bucket.ready(now) and hashes_bucket.ready(now)):
+            return False
+        bytes_bucket.spend(size)
+        hashes_bucket.spend(1)
+        return True
+
+    def wait_time(self, now):
+        return max(bucket.wait_time(now) for bucket in self.buckets)
+
+class ScanScheduler:
+    """
+    Decides which manifest entries are due for a check, by scan tier.
+
+    Entries wait in a heap keyed by their next due time, so each check costs O(log n)
+    instead of a pass over the whole manifest. Each tier in SCAN_TIERS is checked at its
+    own interval, with its entries spread evenly over it so checks do not arrive in one
+    burst, and every PARANOID_REHASH_CYCLES-th check of an entry is a full rehash.
+    """
+
+    def __init__(self, manifest, tier_of, now):
+        self.heap = []
+        self.files = dict.fromkeys(SCAN_TIERS, 0)
+        self.lateness = dict.fromkeys(SCAN_TIERS, 0.0)
+        by_tier = {tier: [] for tier in SCAN_TIERS}
+        for directory, entries in manifest.dirs.items():
+            for name in entries:
+                by_tier[tier_of(os.path.join(directory, name))].append((directory, name))
+        index = 0
+        for tier, entries in by_tier.items():
+            self.files[tier] = len(entries)
+            for position, (directory, name) in enumerate(entries):
+                # The first check of an entry is staggered over its interval, and so is its first full rehash
+                self.heap.append((now + SCAN_TIERS[tier] * position / len(entries), index, tier, directory, name))
+                index += 1
+        heapq.heapify(self.heap)
+
+    def take_due(self, now):
+        """ Reschedule every entry due by now and return them as (filepath, full_rehash, tier, due time) tuples """
+        due = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            when, checks, tier, directory, name = heap[0]
+            interval = SCAN_TIERS[tier]
+            self.record_lateness(tier, now - when)
+            heapq.heapreplace(heap, (max(when + interval, now + interval / 2), checks + 1, tier, directory, name))
+            due.append((os.path.join(directory, name), bool(PARANOID_REHASH_CYCLES) and checks % PARANOID_REHASH_CYCLES == 0, tier, when))
+        return due
+
+    def record_lateness(self, tier, seconds):
+        """ Note that a check of the tier ran seconds after it was due """
+        self.lateness[tier] = max(self.lateness[tier], seconds)
+
+    def next_due(self):
+        return self.heap[0][0] if self.heap else None
+
+    def describe(self):
+        return ', '.join(f"{tier} {count} files every {SCAN_TIERS[tier]}s" for tier, count in self.files.items() if count)
+
+    def report(self):
+        """ Worst-case detection latency per tier since the last report: the tier interval plus the latest a check ran, sweep budget delays included """
+        latencies = ', '.join(f"{tier} {SCAN_TIERS[tier] + self.lateness[tier]:.1f}s" for tier, count in self.files.items() if count)
+        self.lateness = dict.fromkeys(SCAN_TIERS, 0.0)
+        return latencies
+
+class TreeSnapshot:
+    """
+    Entry names and mtimes of every directory in the monitored trees, re-diffed to catch added and dropped files.
+
+    Adding, removing or renaming an entry updates its directory's mtime, so a diff stats each
+    directory and only lists those whose mtime changed: about one stat per directory instead
+    of a full walk. Restore temporaries from replace_file_atomically() are only reported if
+    they are still there at the next diff.
+    """
+
+    def __init__(self, roots, excluded=None):
+        self.roots = roots
+        self.excluded = excluded
+        self.dirs = {}  # Directory -> (mtime_ns, entry names)
+        self.transient = set()
+        self.listed = 0
+        for root in roots:
+            self.scan_tree(root, [])
+
+    def list_directory(self, directory, added, new_dirs, transient):
+        """
+        Record the entries of directory, appending new files to added and new subdirectories to new_dirs.
+
+        :return: The set of names that are gone since it was last listed, or None if it cannot be listed.
+        """
+        try:
+            mtime = os.stat(directory).st_mtime_ns  # Before listing, so a change during the listing is seen next time
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            return None
+        self.listed += 1
+        known = self.dirs.get(directory, (0, set()))[1]
+        names = set()
+        for entry in entries:
+            if self.excluded and self.excluded(entry.path, entry.name):
+                continue
+            if entry.name in known:
+                names.add(entry.name)
+            elif entry.is_dir(follow_symlinks=False):
+                names.add(entry.name)
+                new_dirs.append(entry.path)
+            elif RESTORE_TEMP_NAME.match(entry.name) and entry.path not in self.transient:
+                transient.add(entry.path)
+                mtime = 0  # Not recorded yet, so the directory is listed again at the next diff
             else:
-                logging.warning(f"File deleted or moved: {filepath}")
-                restore_file_from_backup(ssh_session, filepath, expected_hash, permissions, uid, gid)
-                
-        send_logs_to_scp(ssh_session)
-        time.sleep(10)
+                names.add(entry.name)
+                added.append(entry.path)
+        self.dirs[directory] = (mtime, names)
+        return known - names
+
+    def scan_tree(self, top, added):
+        """ Record top and every directory below it, appending the files found to added """
+        stack = [top]
+        while stack:
+            self.list_directory(stack.pop(), added, stack, set())
+
+    def drop_tree(self, top, removed):
+        """ Forget top and every directory below it, appending the files they held to removed """
+        prefix = top + os.sep
+        for directory in [d for d in self.dirs if d == top or d.startswith(prefix)]:
+            _, names = self.dirs.pop(directory)
+            removed.extend(os.path.join(directory, name) for name in names)
+
+    def diff(self):
+        """
+        Compare the monitored trees with the snapshot and update it.
+
+        :return: An (added, removed) tuple of lists of file paths.
+        """
+        added, removed, new_dirs = [], [], []
+        transient = set()
+        self.listed = 0
+        for directory, (mtime, _) in list(self.dirs.items()):
+            if directory not in self.dirs:  # Dropped with its parent earlier in this diff
+                continue
+            try:
+                current = os.stat(directory).st_mtime_ns
+            except OSError:
+                current = None
+            if current == mtime:
+                continue
+            if current is None or (gone := self.list_directory(directory, added, new_dirs, transient)) is None:
+                self.drop_tree(directory, removed)
+                continue
+            for name in gone:
+                path = os.path.join(directory, name)
+                if path in self.dirs:
+                    self.drop_tree(path, removed)
+                else:
+                    removed.append(path)
+        for directory in new_dirs:
+            self.scan_tree(directory, added)
+        for root in self.roots:
+            if root not in self.dirs and os.path.isdir(root):  # Recreated after it was removed
+                self.scan_tree(root, added)
+        self.transient = transient
+        return added, removed
+
+def quarantine_file(filepath):
+    """
+    Move an unexpected file out of the monitored tree into QUARANTINE_DIR, readable only by its owner.
+
+    :return: The quarantined path, or None if the file could not be moved.
+    """
+    target = os.path.join(QUARANTINE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}{filepath.replace(os.sep, '_')}")
+    try:
+        shutil.move(filepath, target)
+        if not os.path.islink(target):
+            os.chmod(target, 0o400)
+    except OSError as e:
+        logging.error(f"Failed to quarantine {filepath}: {e}")
+        return None
+    logging.warning(f"Quarantined {filepath} as {target}.")
+    return target
+
+def report_unexpected_file(filepath):
+    """ Report a file found in a monitored directory without being in the baseline, quarantining it if QUARANTINE_NEW_FILES """
+    logging.warning(f"Unexpected new file in a monitored directory: {filepath}")
+    target = quarantine_file(filepath) if QUARANTINE_NEW_FILES else None
+    journal.record('tamper', path=filepath, change='added', quarantined=target)
+
+def diff_monitored_trees(pipeline, tree, manifest):
+    """ Report files added to the monitored directories, quarantining them if QUARANTINE_NEW_FILES, and check monitored files that were dropped """
+    added, removed = tree.diff()
+    for filepath in added:
+        if filepath not in manifest:
+            report_unexpected_file(filepath)
+    check_files(pipeline, [filepath for filepath in removed if filepath in manifest], manifest)
+
+class BlobCache:
+    """
+    In-memory LRU of small backup copies, so a file restored again is rewritten without reading the store.
+
+    Only copies of at most max_item bytes are kept, and the least recently used ones are
+    dropped once the cached copies exceed max_bytes in total.
+    """
+
+    def __init__(self, max_bytes, max_item):
+        self.max_bytes = max_bytes
+        self.max_item = max_item
+        self.blobs = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()  # Shared by the monitoring thread and the RemoteRestorer
+
+    def get(self, file_hash):
+        with self.lock:
+            data = self.blobs.get(file_hash)
+            if data is not None:
+                self.blobs.move_to_end(file_hash)
+            return data
 
-    ssh_session.close()
+    def put(self, file_hash, data):
+        if len(data) > self.max_item:
+            return
+        with self.lock:
+            if file_hash in self.blobs:
+                return
+            self.blobs[file_hash] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.blobs.popitem(last=False)
+                self.size -= len(evicted)
 
+    def discard(self, file_hash):
+        with self.lock:
+            data = self.blobs.pop(file_hash, None)
+            if data is not None:
+                self.size -= len(data)
 
-def restore_file_from_backup(ssh_session, filepath, expected_hash, permissions, uid, gid):
-    remote_backup_dir = os.path.join(SCP_REMOTE_PATH, local_ip)
-    filename = os.path.basename(filepath)
-    remote_backup_filepath = os.path.join(remote_backup_dir, 'backup', filename)
-    local_dir = os.path.dirname(filepath)
+blob_cache = BlobCache(RESTORE_CACHE_MAX_BYTES, RESTORE_CACHE_MAX_FILE)
 
+class PinnedStore:
+    """
+    Verified content of the files matching PINNED_PATHS, held in memory for the monitor's lifetime.
+
+    Copies are hash-checked once when pinned and never evicted; pinning stops once max_bytes is
+    used. Restores from here need no store read and no rehash, and cannot be affected by a
+    tampered backup store.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.blobs = {}
+        self.size = 0
+
+    def pin(self, file_hash, data):
+        """ Keep data as the content of file_hash; False if it does not match the hash or the budget is used """
+        if file_hash in self.blobs:
+            return True
+        if self.size + len(data) > self.max_bytes or hashlib.sha256(data).hexdigest() != file_hash:
+            return False
+        self.blobs[file_hash] = data
+        self.size += len(data)
+        return True
+
+    def get(self, file_hash):
+        return self.blobs.get(file_hash)
+
+pinned_store = PinnedStore(PINNED_MAX_BYTES)
+
+def pin_files(ssh_pool, manifest):
+    """ Load the verified content of the manifest entries matching PINNED_PATHS into pinned_store """
+    if not PINNED_PATHS:
+        return
+    filepaths = [filepath for filepath in manifest if any(fnmatch.fnmatchcase(filepath, pattern) for pattern in PINNED_PATHS)]
+    evicted = {manifest.get(filepath).hash for filepath in filepaths if not os.path.exists(blob_path(manifest.get(filepath).hash))}
+    if evicted:
+        fetch_blobs(ssh_pool, evicted)
+    for filepath in filepaths:
+        record = manifest.get(filepath)
+        try:
+            with open(blob_path(record.hash), 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            logging.warning(f"Cannot pin {filepath} in memory, its backup copy is unreadable: {e}")
+            continue
+        if not pinned_store.pin(record.hash, data):
+            logging.warning(f"Cannot pin {filepath} in memory, its backup copy does not match its hash or PINNED_MAX_BYTES is used up.")
+    logging.info(f"Pinned {len(pinned_store.blobs)} backup copies for {len(filepaths)} files matching PINNED_PATHS in memory ({pinned_store.size} bytes).")
+
+def restore_file_from_pinned(filepath, record):
+    """ Restore a file straight from its pinned copy; returns False without touching the file if it is not pinned """
+    data = pinned_store.get(record.hash)
+    if data is None:
+        return False
+
+    def write(f):
+        f.write(data)
+        return record.hash  # Verified when it was pinned
+
+    try:
+        restored = replace_file_atomically(filepath, record.hash, record.permissions, record.uid, record.gid, write)
+    except Exception as e:
+        logging.error(f"Failed to restore file from its pinned copy to {filepath}: {e}")
+        return False
+    if restored:
+        logging.info(f"Restored file from its pinned copy in memory. Restored to: {filepath}")
+    return restored
+
+def replace_file_atomically(filepath, expected_hash, permissions, uid, gid, fill):
+    """
+    Write restored content next to filepath and swap it into place only once it is verified.
+
+    fill(f) writes the content into the open temporary file and returns its SHA-256 hex digest.
+    The temporary file is given the recorded ownership and mode and fsynced, then renamed over
+    filepath with os.replace() only if the digest matches expected_hash, so readers never see a
+    partially written file and a failed transfer leaves the current file untouched.
+
+    :return: True if filepath now holds the expected content.
+    """
+    local_dir = os.path.dirname(filepath) or '.'
     os.makedirs(local_dir, exist_ok=True)
-    
-    with SCPClient(ssh_session.get_transport()) as scp:
-        scp.get(remote_backup_filepath, local_path=filepath)
-    logging.info(f"Restored file from backup: {filename}. Restored to: {filepath}")
+    fd, temp_path = tempfile.mkstemp(dir=local_dir, prefix=f'.{os.path.basename(filepath)}.lock-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            current_hash = fill(f)
+            f.flush()
+            try:
+                # Ownership first: chown clears setuid/setgid bits set by chmod
+                os.fchown(f.fileno(), uid, gid)
+                os.fchmod(f.fileno(), permissions)
+                logging.info(f"Successfully applied permissions {oct(permissions)} and ownership (UID: {uid}, GID: {gid}) to {filepath}.")
+            except Exception as e:
+                logging.error(f"Failed to apply permissions {oct(permissions)} and ownership (UID: {uid}, GID: {gid}) to {filepath}: {e}")
+            os.fsync(f.fileno())
+        if current_hash != expected_hash:
+            logging.error(f"Post-recovery integrity check failed for {filepath}, the restored copy was discarded.")
+            os.unlink(temp_path)
+            return False
+        os.replace(temp_path, filepath)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return True
+
+def restore_file_from_memory(filepath, record):
+    """ Restore a file from blob_cache; returns False without touching the file if its content is not cached """
+    data = blob_cache.get(record.hash)
+    if data is None:
+        restore_stats['memory']['misses'] += 1
+        return False
+
+    def write(f):
+        f.write(data)
+        return hashlib.sha256(data).hexdigest()
 
     try:
-        os.chmod(filepath, permissions)
-        os.chown(filepath, uid, gid)
-        logging.info(f"Successfully applied permissions {oct(permissions)} and ownership (UID: {uid}, GID: {gid}) to {filepath}.")
+        restored = replace_file_atomically(filepath, record.hash, record.permissions, record.uid, record.gid, write)
     except Exception as e:
-        logging.error(f"Failed to apply permissions {oct(permissions)} and ownership (UID: {uid}, GID: {gid}) to {filepath}: {e}")
+        logging.error(f"Failed to restore file from memory to {filepath}: {e}")
+        restored = False
+    if not restored:
+        blob_cache.discard(record.hash)
+        restore_stats['memory']['misses'] += 1
+        return False
+    restore_stats['memory']['hits'] += 1
+    logging.info(f"Restored file from memory cache. Restored to: {filepath}")
+    logging.info(f"Post-recovery integrity check passed for {filepath}.")
+    return True
 
-    current_hash = hash_file(filepath)
-    if current_hash != expected_hash:
-        logging.error(f"Post-recovery integrity check failed for {filepath}.")
-    else:
-        logging.info(f"Post-recovery integrity check passed for {filepath}.")
+def restore_file_from_store(filepath, record, tier='local'):
+    """
+    Restore a file from the copy of its content in the local backup store, caching small copies in memory.
+
+    tier names the restore_stats entry credited on success: 'local', or 'remote' for a copy just
+    fetched from the server. Returns False without touching the file if the store has no copy.
+    """
+    backup_filepath = blob_path(record.hash)
+    if not os.path.exists(backup_filepath):
+        restore_stats[tier]['misses'] += 1
+        return False
 
+    def copy(f):
+        # Hash the content while it is written so the integrity check needs no second read
+        with open(backup_filepath, 'rb', buffering=0) as src:
+            if os.fstat(src.fileno()).st_size > blob_cache.max_item:
+                return copy_and_hash(src, f)
+            data = src.readall()
+        f.write(data)
+        current_hash = hashlib.sha256(data).hexdigest()
+        if current_hash == record.hash:
+            blob_cache.put(record.hash, data)
+        return current_hash
 
-def read_cfg_file(cfg_file):
-    """ Read the .cfg file and handle folders or whole paths """
-    items_to_monitor = []
+    try:
+        restored = replace_file_atomically(filepath, record.hash, record.permissions, record.uid, record.gid, copy)
+    except Exception as e:
+        logging.error(f"Failed to restore file from local backup {backup_filepath} to {filepath}: {e}")
+        restored = False
+    if not restored:
+        restore_stats[tier]['misses'] += 1
+        return False
+    restore_stats[tier]['hits'] += 1
+    os.utime(backup_filepath)  # Marks the copy as recently used for trim_local_store()
+    source = 'server' if tier == 'remote' else 'local backup'
+    logging.info(f"Restored file from {source}: {backup_filepath}. Restored to: {filepath}")
+    logging.info(f"Post-recovery integrity check passed for {filepath}.")
+    return True
+
+def describe_restore_stats():
+    return ', '.join(f"{tier} {counts['hits']} hits/{counts['misses']} misses" for tier, counts in restore_stats.items())
+
+
+def read_cfg_entries(cfg_file):
+    """
+    Read the .cfg file as (path, attributes) pairs.
+
+    Each line is a path, optionally followed by key=value attributes, e.g. "/etc/shadow tier=critical".
+    """
+    entries = []
     with open(cfg_file, 'r') as cfg:
         for line in cfg:
             path = line.strip()
-            if os.path.isdir(path):  # If it's a directory, find all files within
-                items_to_monitor.extend(find_files(path))
-            else:  # Otherwise, assume it's a single file
-                items_to_monitor.append(path)
-    return items_to_monitor
-
-def find_files(directory):
-    """ Recursively find all files in a directory """
-    file_list = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            file_list.append(os.path.join(root, file))
-    return file_list
+            attributes = {}
+            match = CFG_ATTRIBUTE.search(path)
+            while match:
+                attributes[match[1]] = match[2]
+                path = path[:match.start()]
+                match = CFG_ATTRIBUTE.search(path)
+            if path:
+                entries.append((os.path.normpath(path), attributes))  # Normalised so manifest paths round-trip through os.path.split
+    return entries
+
+def read_cfg_roots(cfg_file):
+    """ Read the paths listed in the .cfg file """
+    return [path for path, _ in read_cfg_entries(cfg_file) if not path.startswith('!')]
+
+def read_cfg_excludes(cfg_file):
+    """
+    Compile the !pattern lines of the .cfg file into one matcher for the directory walks.
+
+    A pattern containing a slash is matched against the whole path and any other against the
+    entry name, so "!.git" skips every .git directory and "!/var/www/*/cache" each site's cache.
+
+    :return: A function (path, name) returning True for excluded entries, or None without exclude lines.
+    """
+    return compile_excludes([path[1:] for path, _ in read_cfg_entries(cfg_file) if path.startswith('!')])
+
+def compile_excludes(patterns):
+    """ Compile exclude globs, as read by read_cfg_excludes(), into one matcher; None if there are none """
+    if not patterns:
+        return None
+    by_path = [fnmatch.translate(pattern) for pattern in patterns if os.sep in pattern]
+    by_name = [fnmatch.translate(pattern) for pattern in patterns if os.sep not in pattern]
+    path_match = re.compile('|'.join(by_path)).match if by_path else None
+    name_match = re.compile('|'.join(by_name)).match if by_name else None
+
+    def excluded(path, name):
+        return bool((name_match and name_match(name)) or (path_match and path_match(path)))
+    return excluded
+
+def cfg_coverage(lines):
+    """
+    Match paths against a set of services.cfg lines, such as those kept in the manifest.
+
+    :return: A function telling whether a path lies below a directory listed in lines without being excluded by them, or None if lines is empty.
+    """
+    if not lines:
+        return None
+    roots = [line for line in lines if not line.startswith('!')]
+    excluded = compile_excludes([line[1:] for line in lines if line.startswith('!')])
+
+    def covered(filepath):
+        for root in roots:
+            if filepath.startswith(root.rstrip(os.sep) + os.sep) and not (excluded and excluded_below(excluded, root, filepath)):
+                return True
+        return False
+    return covered
+
+def excluded_below(excluded, root, filepath):
+    """ Whether a walk from root skips filepath, because it or a directory between them is excluded """
+    path = filepath
+    while len(path) > len(root):
+        if excluded(path, os.path.basename(path)):
+            return True
+        path = os.path.dirname(path)
+    return False
+
+def read_cfg_tiers(cfg_file):
+    """
+    Read the tier= attributes of the .cfg file.
+
+    A line applies to the path itself, to the files below it, or to the files matching it if
+    it is a glob pattern; a file matched by several lines gets the most frequently checked tier.
+
+    :return: A function mapping a monitored file path to its tier in SCAN_TIERS.
+    """
+    rules = []
+    for path, attributes in read_cfg_entries(cfg_file):
+        tier = attributes.get('tier')
+        if tier is None:
+            continue
+        if tier not in SCAN_TIERS:
+            logging.warning(f"Unknown scan tier {tier} for {path} in {cfg_file}, using {DEFAULT_SCAN_TIER}.")
+            continue
+        rules.append((path, path.rstrip(os.sep) + os.sep, tier))
+
+    def tier_of(filepath):
+        tiers = [tier for path, prefix, tier in rules if filepath == path or filepath.startswith(prefix) or fnmatch.fnmatchcase(filepath, path)]
+        return min(tiers, key=SCAN_TIERS.get, default=DEFAULT_SCAN_TIER)
+    return tier_of
+
+def is_cfg_pattern(path):
+    return any(char in path for char in '*?[')
+
+def read_cfg_file(cfg_file):
+    """
+    Read the .cfg file and yield the files to monitor, walking folders without their excluded entries.
+
+    Each file is yielded once: a walk skips the files and folders that have a line of their own,
+    such as "path tier=critical" inside a listed folder, and leaves them to that line.
+    """
+    excluded = read_cfg_excludes(cfg_file)
+    roots = [path for path in dict.fromkeys(read_cfg_roots(cfg_file)) if not is_cfg_pattern(path)]  # Glob lines only assign attributes to the files they match
+    listed = set(roots)
+
+    def skipped(path, name):
+        return path in listed or bool(excluded and excluded(path, name))
+    for path in roots:
+        if os.path.isdir(path):  # If it's a directory, find all files within
+            yield from find_files(path, skipped)
+        else:  # Otherwise, assume it's a single file, even if an exclude line matches it
+            yield path
+
+def find_files(directory, excluded=None, follow_symlinks=FOLLOW_SYMLINKS):
+    """
+    Recursively yield the files in a directory.
+
+    Walks with os.scandir, whose entries carry the file type from the directory listing so
+    no stat is needed per entry, and holds only a stack of pending directories in memory.
+    Entries matching excluded are skipped, directories without being descended into.
+    Symlinked directories are only followed with follow_symlinks, each at most once.
+    """
+    stack = [directory]
+    seen = set()
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if excluded and excluded(entry.path, entry.name):
+                        continue
+                    if not entry.is_dir():
+                        yield entry.path
+                    elif not entry.is_symlink():
+                        stack.append(entry.path)
+                    elif follow_symlinks:
+                        stat_info = entry.stat()
+                        if (stat_info.st_dev, stat_info.st_ino) not in seen:  # Guards against symlink loops
+                            seen.add((stat_info.st_dev, stat_info.st_ino))
+                            stack.append(entry.path)
+        except OSError:
+            continue  # Unreadable or vanished directory, like os.walk
 
 def main():
     signal.signal(signal.SIGTERM, handle_stop_signals)
     signal.signal(signal.SIGINT, handle_stop_signals)
     
-    backup_and_hash_files()
-    monitor_files()
+    ssh_pool = SSHConnectionPool()
+    backup_and_hash_files(ssh_pool, warm_start=WARM_START)
+    monitor_files(ssh_pool)
+    ssh_pool.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Transfer benchmark for the SCP build of LOCK.py: per-file SFTP versus one bulk tar stream.
+
+Fills a backup store with small config-like files, then uploads it to and downloads it from a
+local stand-in endpoint, once blob by blob over SFTP and once as a single tar archive for each
+bulk compression setting. The stand-in runs the server side of bulk transfers through the local
+sh, tar and sha256sum, and charges a simulated round trip per SFTP request and per exec, so the
+per-file cost it shows is protocol latency rather than disk speed.
+
+Usage: python3 bench_bulk_transfer.py [--files 10000] [--rtt-ms 1.0]
+"""
+import argparse
+import importlib.util
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+LOCK_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'main', 'modules', 'main_ofuscate', 'servicebackup_ofuscate', 'LOCK.py')
+
+def load_lock(work_dir):
+    """ Load a copy of LOCK.py from work_dir, so its backup store and log land there """
+    shutil.copy(LOCK_PATH, work_dir)
+    os.chdir(work_dir)
+    spec = importlib.util.spec_from_file_location('LOCK', os.path.join(work_dir, 'LOCK.py'))
+    lock = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(lock)
+    return lock
+
+class Endpoint:
+    """ Stand-in for a paramiko SSHClient whose remote side is the local filesystem """
+
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.requests = 0
+        self.wire_bytes = 0
+
+    def round_trip(self):
+        self.requests += 1
+        time.sleep(self.rtt)
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return True
+
+    def set_keepalive(self, interval):
+        pass
+
+    def open_sftp(self):
+        return StandInSFTP(self)
+
+    def exec_command(self, command, timeout=None):
+        self.round_trip()
+        process = subprocess.Popen(['sh', '-c', command], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        channel = StandInChannel(process)
+        return StandInStream(self, process.stdin, channel), StandInStream(self, process.stdout, channel), StandInStream(self, process.stderr, channel)
+
+    def close(self):
+        pass
+
+class StandInChannel:
+    closed = False
+
+    def __init__(self, process):
+        self.process = process
+
+    def settimeout(self, timeout):
+        pass
+
+    def shutdown_write(self):
+        self.process.stdin.close()
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+class StandInStream:
+    def __init__(self, endpoint, pipe, channel):
+        self.endpoint = endpoint
+        self.pipe = pipe
+        self.channel = channel
+
+    def write(self, data):
+        data = data.encode() if isinstance(data, str) else data
+        self.endpoint.wire_bytes += len(data)
+        self.pipe.write(data)
+
+    def read(self, size=-1):
+        data = self.pipe.read(size)
+        self.endpoint.wire_bytes += len(data)
+        return data
+
+class StandInSFTP:
+    """ The SFTP requests LOCK.py makes, each charged one round trip like the real protocol """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.channel = StandInChannel(None)
+
+    def get_channel(self):
+        return self.channel
+
+    def stat(self, path):
+        self.endpoint.round_trip()
+        return os.stat(path)
+
+    def mkdir(self, path):
+        self.endpoint.round_trip()
+        os.mkdir(path)
+
+    def put(self, local_path, remote_path):
+        # open, pipelined writes, close and the confirming stat
+        for _ in range(3):
+            self.endpoint.round_trip()
+        shutil.copyfile(local_path, remote_path)
+        self.endpoint.wire_bytes += os.path.getsize(local_path)
+        return os.stat(remote_path)
+
+    def open(self, path, mode='r'):
+        # open and close
+        for _ in range(2):
+            self.endpoint.round_trip()
+        self.endpoint.wire_bytes += os.path.getsize(path)
+        return open(path, mode, buffering=0)
+
+def config_like_file(rng):
+    lines = [f"{rng.choice(['listen', 'server_name', 'root', 'include', 'option', 'timeout'])} {rng.randrange(1 << 20):x};" for _ in range(rng.randint(20, 120))]
+    return ('\n'.join(lines) + '\n').encode()
+
+def fill_store(lock, count):
+    rng = random.Random(1)
+    hashes = []
+    for _ in range(count):
+        data = config_like_file(rng)
+        file_hash = lock.hashlib.sha256(data).hexdigest()
+        os.makedirs(os.path.dirname(lock.blob_path(file_hash)), exist_ok=True)
+        with open(lock.blob_path(file_hash), 'wb') as f:
+            f.write(data)
+        hashes.append(file_hash)
+    return hashes
+
+def reset(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+def per_file_download(lock, sftp, hashes):
+    fetched = set()
+    for file_hash in hashes:
+        with sftp.open(lock.blob_path(file_hash, lock.REMOTE_BACKUP_DIR), 'rb') as f:
+            if lock.store_blob(f, file_hash):
+                fetched.add(file_hash)
+    return fetched
+
+def measure(label, endpoint, transfer):
+    endpoint.requests = endpoint.wire_bytes = 0
+    start = time.perf_counter()
+    transfer()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed:9.2f} {endpoint.requests:10} {endpoint.wire_bytes / 1048576:12.2f}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--rtt-ms', type=float, default=1.0)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench-bulk-')
+    try:
+        lock = load_lock(work_dir)
+        lock.logging.disable(lock.logging.CRITICAL)
+        lock.REMOTE_BACKUP_DIR = os.path.join(work_dir, 'remote')
+        endpoint = Endpoint(args.rtt_ms / 1000)
+        pool = lock.SSHConnectionPool(lambda: endpoint)
+        hashes = fill_store(lock, args.files)
+        store_bytes = sum(os.path.getsize(lock.blob_path(file_hash)) for file_hash in hashes)
+        print(f"{args.files} files, {store_bytes / 1048576:.2f} MiB, simulated round trip {args.rtt_ms} ms")
+        print(f"{'transfer':<28} {'seconds':>9} {'requests':>10} {'wire MiB':>12}")
+
+        reset(lock.REMOTE_BACKUP_DIR)
+        measure('upload, per-file SFTP', endpoint, lambda: pool.run(lambda sftp: lock.upload_blobs(sftp, hashes)))
+        for compression in ('', 'gz', 'xz'):
+            lock.BULK_TRANSFER_COMPRESSION = compression
+            reset(lock.REMOTE_BACKUP_DIR)
+            measure(f"upload, bulk tar {compression or 'plain'}", endpoint, lambda: lock.upload_blobs_bulk(pool, hashes))
+            assert sum(len(files) for _, _, files in os.walk(lock.REMOTE_BACKUP_DIR)) == len(hashes)
+
+        for shard in os.listdir(lock.BACKUP_DIR):
+            if len(shard) == 2:
+                shutil.rmtree(os.path.join(lock.BACKUP_DIR, shard))
+        measure('download, per-file SFTP', endpoint, lambda: pool.run(lambda sftp: per_file_download(lock, sftp, hashes)))
+        for compression in ('', 'gz', 'xz'):
+            lock.BULK_TRANSFER_COMPRESSION = compression
+            measure(f"download, bulk tar {compression or 'plain'}", endpoint, lambda: lock.download_blobs_bulk(pool, hashes) == set(hashes) or exit('bulk download lost blobs'))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for LOCK.py hash_file().
+
+Compares the old whole-file read against the streaming hasher at several chunk sizes
+(and the optional mmap path), reporting throughput and the peak Python heap used per call
+(the streaming buffer is allocated once and reused, so it is not counted per call).
+
+Usage: python3 bench_hash_file.py [--size-mb 256] [--repeat 3]
+"""
+import argparse
+import hashlib
+import importlib.util
+import os
+import tempfile
+import time
+import tracemalloc
+
+LOCK_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'main', 'modules', 'servicebackup', 'LOCK.py')
+CHUNK_SIZES = [4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+def load_lock():
+    spec = importlib.util.spec_from_file_location('LOCK', LOCK_PATH)
+    lock = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(lock)
+    return lock
+
+def hash_whole_file(filepath):
+    """ The original implementation, reading the whole file at once """
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        hasher.update(f.read())
+    return hasher.hexdigest()
+
+def measure(func, repeat):
+    """ Best wall time over repeat runs, then peak traced allocation of one extra run """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    lock = load_lock()
+    size = args.size_mb * 1024 * 1024
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            f.write(block)
+        filepath = f.name
+
+    try:
+        expected = hash_whole_file(filepath)
+        cases = [('whole-file read', lambda: hash_whole_file(filepath))]
+        for chunk_size in CHUNK_SIZES:
+            cases.append((f'readinto {chunk_size // 1024} KiB', lambda c=chunk_size: lock.hash_file(filepath, c)))
+
+        def hash_mmap():
+            lock.HASH_MMAP_THRESHOLD = 1
+            try:
+                return lock.hash_file(filepath)
+            finally:
+                lock.HASH_MMAP_THRESHOLD = 0
+        cases.append(('mmap 1 MiB slices', hash_mmap))
+
+        print(f"{'variant':<22} {'best s':>8} {'MiB/s':>8} {'peak heap KiB':>14}")
+        for name, func in cases:
+            assert func() == expected, name
+            best, peak = measure(func, args.repeat)
+            print(f"{name:<22} {best:8.3f} {size / best / 1048576:8.0f} {peak / 1024:14.0f}")
+    finally:
+        os.unlink(filepath)
+
+if __name__ == "__main__":
+    main()
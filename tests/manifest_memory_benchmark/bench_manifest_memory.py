@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark for the LOCK.py in-memory manifest.
+
+Builds the same synthetic manifest twice: once as the dictionaries the monitor used to keep
+(hex hash strings, permissions, (uid, gid) tuples and fingerprint tuples keyed by full path)
+and once as a LOCK.Manifest of FileRecords, and reports traced Python heap bytes per entry.
+
+Usage: python3 bench_manifest_memory.py [--entries 200000] [--files-per-dir 50]
+"""
+import argparse
+import gc
+import hashlib
+import importlib.util
+import os
+import tracemalloc
+
+LOCK_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'main', 'modules', 'servicebackup', 'LOCK.py')
+
+def load_lock():
+    spec = importlib.util.spec_from_file_location('LOCK', LOCK_PATH)
+    lock = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(lock)
+    return lock
+
+def synthetic_entries(count, files_per_dir):
+    """ (path, digest, permissions, uid, gid, (size, mtime_ns, ctime_ns, inode, device)) tuples """
+    for i in range(count):
+        path = f"/var/www/vhost{i // (files_per_dir * 20)}/htdocs/module{i // files_per_dir}/file{i}.php"
+        digest = hashlib.sha256(path.encode()).digest()
+        yield path, digest, 0o644, 33, 33, (1000 + i, 1700000000000000000 + i, 1700000000000000000 + i, 5000000 + i, 2049)
+
+def build_dicts(entries):
+    """ The representation monitor_files() used before FileRecord, parsed from CSV lines as it was """
+    hashes, permissions, owners, fingerprints = {}, {}, {}, {}
+    for path, digest, mode, uid, gid, fingerprint in entries:
+        line = f"{path},{digest.hex()},{mode},{uid},{gid}," + ','.join(map(str, fingerprint))
+        parts = line.strip().split(',')
+        filepath, file_hash = parts[0], parts[1]
+        permissions[filepath] = int(parts[2])
+        hashes[filepath] = file_hash
+        owners[filepath] = (int(parts[3]), int(parts[4]))
+        fingerprints[filepath] = tuple(map(int, parts[5:10]))
+    return hashes, permissions, owners, fingerprints
+
+def build_manifest(lock, entries):
+    manifest = lock.Manifest(':memory:')
+    for path, digest, mode, uid, gid, fingerprint in entries:
+        manifest.remember(path, lock.FileRecord(digest, mode, uid, gid, lock.FINGERPRINT_STRUCT.pack(*fingerprint)))
+    return manifest
+
+def traced_bytes(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=200000)
+    parser.add_argument('--files-per-dir', type=int, default=50)
+    args = parser.parse_args()
+
+    lock = load_lock()
+    entries = list(synthetic_entries(args.entries, args.files_per_dir))
+    before, before_bytes = traced_bytes(lambda: build_dicts(entries))
+    del before
+    after, after_bytes = traced_bytes(lambda: build_manifest(lock, entries))
+    assert len(after) == args.entries
+
+    print(f"{'representation':<34} {'total MiB':>10} {'bytes/entry':>12}")
+    print(f"{'dicts of str/tuple (before)':<34} {before_bytes / 1048576:10.1f} {before_bytes / args.entries:12.0f}")
+    print(f"{'Manifest of FileRecord (after)':<34} {after_bytes / 1048576:10.1f} {after_bytes / args.entries:12.0f}")
+
+if __name__ == "__main__":
+    main()
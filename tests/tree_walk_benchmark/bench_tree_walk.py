@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the LOCK.py directory walk.
+
+Builds a synthetic web root where most files live in cache, upload and .git directories, then
+walks it the way read_cfg_file() used to (os.walk into a full path list, no excludes) and with
+LOCK.find_files() and the exclude lines below, reporting time and peak traced Python heap.
+
+Usage: python3 bench_tree_walk.py [--files 500000] [--files-per-dir 100] [--dir /tmp/walk-bench]
+"""
+import argparse
+import importlib.util
+import os
+import shutil
+import time
+import tracemalloc
+
+LOCK_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'main', 'modules', 'servicebackup', 'LOCK.py')
+CHURN_DIRS = ['cache', 'uploads', '.git/objects']  # Where 9 of every 10 files go
+EXCLUDES = ['!.git', '!*/cache', '!*/uploads']
+
+def load_lock():
+    spec = importlib.util.spec_from_file_location('LOCK', LOCK_PATH)
+    lock = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(lock)
+    return lock
+
+def build_tree(root, count, files_per_dir):
+    for i in range(0, count, files_per_dir):
+        site = f"site{i // (files_per_dir * 50)}"
+        chunk = i // files_per_dir
+        subdir = f"module{chunk}" if chunk % 10 == 0 else f"{CHURN_DIRS[chunk % len(CHURN_DIRS)]}/d{chunk}"
+        directory = os.path.join(root, site, subdir)
+        os.makedirs(directory, exist_ok=True)
+        for j in range(files_per_dir):
+            open(os.path.join(directory, f"f{j}.php"), 'w').close()
+
+def walk_before(directory):
+    """ find_files() as it was: os.walk into a full list """
+    file_list = []
+    for root, _, files in os.walk(directory):
+        for file in files:
+            file_list.append(os.path.join(root, file))
+    return file_list
+
+def measure(walk):
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = walk()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count, elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=500000)
+    parser.add_argument('--files-per-dir', type=int, default=100)
+    parser.add_argument('--dir', default='/tmp/walk-bench')
+    args = parser.parse_args()
+
+    lock = load_lock()
+    shutil.rmtree(args.dir, ignore_errors=True)
+    build_tree(args.dir, args.files, args.files_per_dir)
+    cfg = os.path.join(args.dir, 'services.cfg')
+    with open(cfg, 'w') as f:
+        f.write('\n'.join(EXCLUDES))
+    excluded = lock.read_cfg_excludes(cfg)
+    os.unlink(cfg)
+
+    walk_before(args.dir)  # Warm the dentry cache so both walks are measured alike
+    rows = [
+        ('os.walk list, no excludes (before)', measure(lambda: len(walk_before(args.dir)))),
+        ('find_files(), no excludes', measure(lambda: sum(1 for _ in lock.find_files(args.dir)))),
+        ('find_files() with excludes (after)', measure(lambda: sum(1 for _ in lock.find_files(args.dir, excluded)))),
+    ]
+    print(f"{'walk':<38} {'files':>8} {'seconds':>8} {'peak MiB':>9}")
+    for name, (count, elapsed, peak) in rows:
+        print(f"{name:<38} {count:8d} {elapsed:8.2f} {peak / 1048576:9.1f}")
+    shutil.rmtree(args.dir)
+
+if __name__ == "__main__":
+    main()
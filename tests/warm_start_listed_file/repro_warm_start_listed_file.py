@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Reproduction for warm starts of the LOCK.py baseline.
+
+Takes a baseline of a directory, then adds two files below it while the monitor is stopped:
+new.php, which also gets its own services.cfg line, and shell.php, which does not. A warm
+start must back up new.php and report shell.php as unexpected, with QUARANTINE_NEW_FILES
+moving only shell.php away.
+
+Usage: python3 repro_warm_start_listed_file.py [--dir /tmp/warm-start-repro]
+"""
+import argparse
+import importlib.util
+import os
+import shutil
+
+LOCK_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'main', 'modules', 'servicebackup', 'LOCK.py')
+
+def load_lock(directory):
+    """ Import a copy of LOCK.py placed in directory, so its backup store, quarantine, services.cfg and log live there """
+    path = shutil.copy(LOCK_PATH, directory)
+    os.chdir(directory)
+    spec = importlib.util.spec_from_file_location('LOCK', path)
+    lock = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(lock)
+    return lock
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default='/tmp/warm-start-repro')
+    args = parser.parse_args()
+
+    shutil.rmtree(args.dir, ignore_errors=True)
+    www = os.path.join(args.dir, 'tree', 'www')
+    os.makedirs(www)
+    lock = load_lock(args.dir)
+    lock.QUARANTINE_NEW_FILES = True
+
+    write(os.path.join(www, 'a.php'), 'a\n')
+    write(lock.MONITOR_CFG, f"{www}\n")
+    lock.backup_and_hash_files()
+
+    write(os.path.join(www, 'new.php'), 'new\n')
+    write(os.path.join(www, 'shell.php'), 'shell\n')
+    write(lock.MONITOR_CFG, f"{www}\n{www}/new.php\n")
+    lock.backup_and_hash_files(warm_start=True)
+
+    manifest = lock.Manifest(os.path.join(lock.BACKUP_DIR, lock.MANIFEST_FILE)).load()
+    checks = [
+        ('new.php backed up', os.path.join(www, 'new.php') in manifest),
+        ('new.php left in place', os.path.exists(os.path.join(www, 'new.php'))),
+        ('shell.php not backed up', os.path.join(www, 'shell.php') not in manifest),
+        ('shell.php quarantined', not os.path.exists(os.path.join(www, 'shell.php'))),
+    ]
+    manifest.close()
+    for name, passed in checks:
+        print(f"{'ok  ' if passed else 'FAIL'} {name}")
+    shutil.rmtree(args.dir)
+    raise SystemExit(0 if all(passed for _, passed in checks) else 1)
+
+if __name__ == "__main__":
+    main()